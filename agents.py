@@ -1,3 +1,7 @@
+import os
+import copy
+import json
+
 import numpy as np
 from utils import argmax
 
@@ -5,6 +9,20 @@ import torch
 import torch.nn as nn
 
 
+def save_tensors(path, tensors):
+    '''
+    A function to save a dictionary of tensors as an npz file
+    '''
+    np.savez(path, **{key: value.detach().cpu().numpy() for key, value in tensors.items()})
+
+def load_tensors(path):
+    '''
+    A function that loads a dictionary of tensors from an npz file
+    '''
+    with np.load(path) as values:
+        return {key: torch.from_numpy(values[key]) for key in values.files}
+
+
 class BaseAgent:
     '''
     The base agent class that needs to be overwritten.
@@ -194,56 +212,210 @@ class DQNAgent():
     '''
     Our deep q-learning agent.
     '''
-    def __init__(self, model, epsilon=.01, discount=.99, seed=876438985230):
+    def __init__(self, model, epsilon=.01, discount=.99, seed=876438985230, target_update=None, tau=None, double_dqn=False, n_steps=1):
         '''
-        Initialize object
+        Initialize object. The targets are bootstrapped from self.model unless a frozen
+        target network is requested, either hard copied every 'target_update' updates
+        or soft updated with a Polyak coefficient 'tau' after every update.
+        With 'n_steps' > 1, the transitions are expected to be n-step ones (see
+        memory.NStepTransitions) and are bootstrapped with discount ** n_steps.
         '''
         self.rng_ = self.rng_ = np.random.default_rng(seed=seed)
         self.num_actions_ = 3
         
         self.discount_ = discount
         self.epsilon_ = epsilon
+        self.n_steps_ = n_steps
         self.model = model
         self.criterion_ = nn.MSELoss()
         self.optim = torch.optim.Adam(self.model.parameters(), lr=0.005)
 
+        self.num_updates_ = 0
+        self.td_errors_ = None
+        self.input_ = None
+        self.set_target_network(target_update=target_update, tau=tau, double_dqn=double_dqn)
+
+    def set_target_network(self, target_update=None, tau=None, double_dqn=False):
+        '''
+        A method to (re)configure the target network and the Double-DQN action selection
+        '''
+        assert target_update is None or tau is None, "Choose either hard ('target_update') or soft ('tau') target updates"
+        assert tau is None or 0. < tau <= 1., "The Polyak coefficient 'tau' should be in (0, 1]"
+        assert target_update is None or target_update > 0, "The number of updates between target syncs 'target_update' should be positive"
+        assert not double_dqn or target_update is not None or tau is not None, "Double-DQN needs a target network, give 'target_update' or 'tau'"
+        self.target_update_ = target_update
+        self.tau_ = tau
+        self.double_dqn_ = double_dqn
+
+        self.target_model = None
+        if target_update is not None or tau is not None:
+            self.target_model = copy.deepcopy(self.model)
+            self.target_model.requires_grad_(False)
+
+    def update_target_network(self):
+        '''
+        A method to update the target network after a training step
+        '''
+        if self.target_model is None:
+            return
+        if self.tau_ is not None:
+            with torch.no_grad():
+                for target_param, param in zip(self.target_model.parameters(), self.model.parameters()):
+                    target_param.lerp_(param, self.tau_)
+        elif self.num_updates_ % self.target_update_ == 0:
+            self.target_model.load_state_dict(self.model.state_dict())
+
     def step(self, state):
         '''
         The method that makes the agent take a step (choose an action)
         '''
         if self.rng_.random() < self.epsilon_:
             return self.rng_.integers(self.num_actions_)
-        with torch.no_grad():
-            estimated_q = self.model(torch.from_numpy(state).float())
-            action = torch.argmax(estimated_q)
-            return action.item()
+        # The state is copied into a preallocated input, no tensor is allocated per step
+        if self.input_ is None or len(self.input_) != len(state):
+            self.input_ = torch.empty(len(state))
+        with torch.inference_mode():
+            self.input_.copy_(torch.from_numpy(state))
+            return int(self.model(self.input_).argmax())
 
-    def train(self, batch):
+    def save(self, path):
+        '''
+        A method to write the agent in a directory: the model, target model and optimizer
+        tensors as npz files, the hyperparameters, counters and random generator state
+        in a json file
+        '''
+        os.makedirs(path, exist_ok=True)
+        save_tensors(os.path.join(path, "model.npz"), self.model.state_dict())
+        if self.target_model is not None:
+            save_tensors(os.path.join(path, "target_model.npz"), self.target_model.state_dict())
+        optim_state = self.optim.state_dict()
+        save_tensors(os.path.join(path, "optimizer.npz"),
+                     {f"{index}.{name}": value for index, state in optim_state["state"].items() for name, value in state.items()})
+        config = {
+            "epsilon": self.epsilon_, "discount": self.discount_, "n_steps": self.n_steps_, "num_updates": self.num_updates_,
+            "target_update": self.target_update_, "tau": self.tau_, "double_dqn": self.double_dqn_,
+            "random_gen": self.rng_.bit_generator.state, "param_groups": optim_state["param_groups"],
+        }
+        with open(os.path.join(path, "agent.json"), "w") as f:
+            json.dump(config, f)
+
+    def load(self, path):
         '''
-        Takes a batch of states to train the model on
+        A method to restore an agent written by save in place, the model architecture
+        must match
         '''
-        batch_size = len(batch)
-        inputs = []
-        targets = []
-        
-        # Break down the 'batch' to build the inputs of the pytorch model
-        for idx in range(batch_size):
-            state, action, new_state, reward, is_done = batch[idx]
-            inputs.append(state)
+        with open(os.path.join(path, "agent.json")) as f:
+            config = json.load(f)
+        self.epsilon_, self.discount_, self.num_updates_ = config["epsilon"], config["discount"], config["num_updates"]
+        self.n_steps_ = config.get("n_steps", 1)
+        self.rng_.bit_generator.state = config["random_gen"]
 
-            # Compute target with updated q-value for best action
-            target = self.model(torch.from_numpy(state).float()).detach()
-            best_q = torch.max(self.model(torch.from_numpy(new_state).float())).detach()
-            target[action] = .0 if is_done else reward + self.discount_ * best_q
-            targets.append(target)
+        self.model.load_state_dict(load_tensors(os.path.join(path, "model.npz")))
+        self.set_target_network(target_update=config["target_update"], tau=config["tau"], double_dqn=config["double_dqn"])
+        if self.target_model is not None:
+            self.target_model.load_state_dict(load_tensors(os.path.join(path, "target_model.npz")))
 
-        inputs = np.stack(inputs)
-        targets = np.stack(targets)
+        state = {}
+        for key, value in load_tensors(os.path.join(path, "optimizer.npz")).items():
+            index, name = key.split(".", 1)
+            state.setdefault(int(index), {})[name] = value
+        # json turned the tuples of the parameter groups, e.g. Adam betas, into lists
+        param_groups = [{key: tuple(value) if isinstance(value, list) and key != "params" else value for key, value in group.items()}
+                        for group in config["param_groups"]]
+        self.optim.load_state_dict({"state": state, "param_groups": param_groups})
+
+    def get_split_policy(self, num_market_features):
+        '''
+        A method that returns the greedy policy of the agent as a SplitPolicy
+        '''
+        return SplitPolicy(self, num_market_features)
+
+    def train(self, batch, weights=None):
+        '''
+        Takes a batch of transitions to train the model on, given as the
+        (states, actions, new_states, rewards, dones) arrays of a replay memory.
+        Optional importance-sampling weights scale the loss of every transition.
+        The TD errors of the batch are kept in self.td_errors_ to update priorities.
+        '''
+        states, actions, new_states, rewards, dones = batch
+        states = torch.from_numpy(states).float()
+        actions = torch.from_numpy(actions).long().unsqueeze(1)
+
+        y_pred = self.model(states)
+
+        # Compute targets with updated q-value for the action taken. Terminal 1-step
+        # targets are zero, as they always were, while the n-step sums flushed at the end
+        # of an episode (see NStepTransitions) are kept as targets, only not bootstrapped
+        with torch.no_grad():
+            new_states = torch.from_numpy(new_states).float()
+            target_model = self.target_model if self.target_model is not None else self.model
+            new_q = target_model(new_states)
+            if self.double_dqn_:
+                # The online model chooses the best action, the target model evaluates it
+                best_actions = self.model(new_states).argmax(dim=1, keepdim=True)
+                best_q = new_q.gather(1, best_actions).squeeze(1)
+            else:
+                best_q = new_q.max(dim=1).values
+            dones = torch.from_numpy(dones)
+            if self.n_steps_ > 1:
+                best_q = best_q.masked_fill(dones, .0)
+            updates = torch.from_numpy(rewards).float() + self.discount_ ** self.n_steps_ * best_q
+            if self.n_steps_ == 1:
+                updates = updates.masked_fill(dones, .0)
+            targets = y_pred.detach().clone().scatter_(1, actions, updates.unsqueeze(1))
+
+        self.td_errors_ = (updates - y_pred.detach().gather(1, actions).squeeze(1)).numpy()
 
         # Compute loss and back-propagate
-        y_pred = self.model(torch.from_numpy(inputs).float())
-        loss = self.criterion_(y_pred, torch.from_numpy(targets).float().detach())
+        if weights is None:
+            loss = self.criterion_(y_pred, targets)
+        else:
+            loss = (torch.from_numpy(weights).float().unsqueeze(1) * (y_pred - targets) ** 2).mean()
         self.optim.zero_grad()
         loss.backward()
         self.optim.step()
+
+        self.num_updates_ += 1
+        self.update_target_network()
         return loss.sum().item()
+
+
+class SplitPolicy:
+    '''
+    The policy of a DQNAgent with a DenseModel, for whole-episode evaluation. The market
+    features do not depend on the actions: their part of the first layer is computed for
+    every step in one pass, and only the portfolio part and the two small layers left are
+    resolved step by step, in numpy. The weights are copied, retraining the agent requires
+    a new policy.
+    '''
+    def __init__(self, agent, num_market_features):
+        self.agent_ = agent
+        model = agent.model
+        weights = [(layer.weight.detach().numpy().T.copy(), layer.bias.detach().numpy().copy()) for layer in (model.l1_, model.l2_, model.l3_)]
+        (weight, self.bias_), self.layers_ = weights[0], weights[1:]
+        self.market_weight_ = np.ascontiguousarray(weight[:num_market_features])
+        self.portfolio_weight_ = np.ascontiguousarray(weight[num_market_features:])
+
+    def project(self, market_states):
+        '''
+        A method that returns the first layer pre-activations of the (steps, features)
+        market states, bias included
+        '''
+        projected = np.asarray(market_states, dtype=np.float32) @ self.market_weight_
+        projected += self.bias_
+        return projected
+
+    def step(self, projected, portfolio_state):
+        '''
+        A method that chooses an action from the projection of the market state and the
+        portfolio state, epsilon-greedily with the random generator of the agent
+        '''
+        agent = self.agent_
+        if agent.rng_.random() < agent.epsilon_:
+            return agent.rng_.integers(agent.num_actions_)
+        output = projected + portfolio_state.astype(np.float32) @ self.portfolio_weight_
+        for weight, bias in self.layers_:
+            np.maximum(output, 0., out=output)
+            output = output @ weight
+            output += bias
+        return int(output.argmax())
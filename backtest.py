@@ -0,0 +1,78 @@
+'''
+The file that contains the vectorized backtester: once the actions are known, the path of
+a Portfolio is a deterministic function of the prices, so many action sequences can be
+scored against the same history at once with numpy cumulative operations.
+'''
+import numpy as np
+
+from portfolio import SPREAD
+
+
+def backtest(prices, actions, spending_limit=20_000, num_coins_per_order=1., spread=SPREAD):
+    '''
+    A function that replays action sequences (0 hold, 1 buy, 2 sell) of shape (T,) or
+    (sequences, T) on a price array of shape (T,), the action at t being applied at the
+    price at t as Portfolio.apply_action does, spread and spending limit included.
+    Returns a dictionary of (sequences, T) arrays of the states after every action:
+    coin, cash, cash_used and total_value, plus the final roi in percent of every sequence.
+    '''
+    prices = np.asarray(prices, dtype=np.float64)
+    actions = np.atleast_2d(actions)
+    assert actions.shape[1] == len(prices) > 0, "There should be one action per price"
+    num_sequences, length = actions.shape
+    buy_prices = prices * (1 + spread)
+    sell_prices = prices * (1 - spread)
+
+    # The spending limit makes buys depend on the past ones: a scan over time, vectorized
+    # over the sequences. cash_used only grows, so a buy refused at some price is refused
+    # for good once cash_used + the lowest price left is above the limit.
+    is_buying = (actions == 1) & (prices != 0)
+    buy_costs = np.zeros((num_sequences, length))
+    cash_used = np.zeros(num_sequences)
+    remaining_min = np.minimum.accumulate(buy_prices[::-1])[::-1]
+    candidates = np.flatnonzero(is_buying.any(axis=0))
+    for t in candidates:
+        can_buy = is_buying[:, t] & ((cash_used + buy_prices[t]) <= spending_limit)
+        cost = num_coins_per_order * buy_prices[t]
+        buy_costs[can_buy, t] = cost
+        cash_used = np.where(can_buy, cash_used + cost, cash_used)
+        if np.all(cash_used + remaining_min[t] > spending_limit):
+            break
+    cash_used = np.cumsum(buy_costs, axis=1)
+
+    # Coins follow a walk reflected at 0: a sell never takes more than the coins held.
+    # Buffers are reused in place, these arrays are (sequences, T) each.
+    is_selling = (actions == 2) & (prices != 0)
+    steps = np.where(is_selling, -num_coins_per_order, 0.)
+    steps[buy_costs > 0] = num_coins_per_order
+    coin = np.cumsum(steps, axis=1)
+    running_min = np.minimum.accumulate(coin, axis=1, out=steps)
+    np.minimum(running_min, 0., out=running_min)
+    coin -= running_min
+
+    # A sell at t takes at most the coins held after t - 1 (none before the first action)
+    sold = running_min
+    sold[:, 0] = 0.
+    np.minimum(coin[:, :-1], num_coins_per_order, out=sold[:, 1:])
+    sold[~is_selling] = 0.
+    sold *= sell_prices
+    cash = np.cumsum(sold, axis=1, out=sold)
+
+    total_value = coin * sell_prices
+    total_value += cash
+    final_cash_used, final_value = cash_used[:, -1], total_value[:, -1]
+    has_spent = final_cash_used != 0.
+    roi = np.where(has_spent, 100 * (final_value - final_cash_used) / np.where(has_spent, final_cash_used, 1.), 0.)
+
+    return {"coin": coin, "cash": cash, "cash_used": cash_used, "total_value": total_value, "roi": roi}
+
+
+if __name__ == "__main__":
+    from loader import TradingDataLoader
+    from environments import TradingBotEnv
+
+    environment = TradingBotEnv(TradingDataLoader().data())
+    random_gen = np.random.default_rng(seed=0)
+    actions = random_gen.integers(3, size=(1_000, environment.length_))
+    results = backtest(environment.prices_, actions)
+    print(f"Best ROI of {len(actions)} random policies: {results['roi'].max(): .2f}%")
@@ -0,0 +1,526 @@
+'''
+The file that contains the benchmarks of the project hot paths: before/after comparisons
+of the optimized ones (--legacy) and a suite run on the bundled csv and on synthetic data
+scaled from it, whose JSON results are compared against a saved baseline, e.g.
+
+    python benchmarks.py --save-baseline baseline.json
+    python benchmarks.py --baseline baseline.json
+
+which exits with an error if any measure regressed by more than its threshold.
+'''
+import time
+
+import numpy as np
+
+
+def legacy_step(environment):
+    '''
+    The former TradingBotEnv.step, that looked every metric up in the pandas
+    state dictionary. Kept as a reference point for the benchmarks.
+    '''
+    is_done = environment.is_done_[environment.current_index_]
+    observation = []
+    for metric in environment.metrics_:
+        observation.append(environment.state_dict_[metric].iloc[environment.current_index_])
+    if not is_done:
+        environment.current_index_ += 1
+    return is_done, observation
+
+def legacy_train(agent, batch):
+    '''
+    The former DQNAgent.train, that ran two forward passes per sample to build the
+    targets. Kept as a reference point for the benchmarks.
+    '''
+    import torch
+
+    inputs = []
+    targets = []
+    for state, action, new_state, reward, is_done in zip(*batch):
+        inputs.append(state)
+        target = agent.model(torch.from_numpy(state).float()).detach()
+        best_q = torch.max(agent.model(torch.from_numpy(new_state).float())).detach()
+        target[action] = .0 if is_done else reward + agent.discount_ * best_q
+        targets.append(target)
+
+    inputs = np.stack(inputs)
+    targets = np.stack(targets)
+
+    y_pred = agent.model(torch.from_numpy(inputs).float())
+    loss = agent.criterion_(y_pred, torch.from_numpy(targets).float().detach())
+    agent.optim.zero_grad()
+    loss.backward()
+    agent.optim.step()
+    return loss.sum().item()
+
+def legacy_policy_step(agent, state):
+    '''
+    The former greedy DQNAgent.step, that built a new input tensor under no_grad at
+    every step. Kept as a reference point for the benchmarks.
+    '''
+    import torch
+
+    with torch.no_grad():
+        return torch.argmax(agent.model(torch.from_numpy(state).float())).item()
+
+def steps_per_second(step, environment, repeats=3):
+    '''
+    A function that runs full episodes with the given step function and returns
+    the best throughput in steps per second
+    '''
+    best = 0.
+    for _ in range(repeats):
+        environment.reset()
+        is_done, num_steps = False, 0
+        start = time.perf_counter()
+        while not is_done:
+            is_done, _ = step(environment)
+            num_steps += 1
+        best = max(best, num_steps / (time.perf_counter() - start))
+    return best
+
+def benchmark_environment_step(data, repeats=3):
+    '''
+    A function that compares the pandas lookup step with the feature matrix step
+    '''
+    from environments import TradingBotEnv
+
+    environment = TradingBotEnv(data)
+    before = steps_per_second(legacy_step, environment, repeats=repeats)
+    after = steps_per_second(lambda env: env.step(), environment, repeats=repeats)
+    return {"before": before, "after": after, "speedup": after / before}
+
+def benchmark_vector_environment_step(data, num_envs=64, num_steps=2_000, seed=0):
+    '''
+    A function that measures the number of transitions per second of the batched
+    environment, random actions and rewards included
+    '''
+    from environments import TradingBotEnv, VectorTradingBotEnv
+
+    random_gen = np.random.default_rng(seed=seed)
+    environment = TradingBotEnv(data)
+    starts = random_gen.integers(0, environment.length_ - num_steps, size=num_envs)
+    vector_environment = VectorTradingBotEnv(environment, starts=starts)
+    actions = random_gen.integers(3, size=(num_steps, num_envs))
+
+    start = time.perf_counter()
+    for step_actions in actions:
+        vector_environment.step(step_actions)
+    return {"num_envs": num_envs, "transitions_per_sec": num_envs * num_steps / (time.perf_counter() - start)}
+
+def random_batch(random_gen, batch_size, state_dimension=17):
+    '''
+    A function that builds a batch of random transitions shaped like the ones of
+    a ReplayBuffer
+    '''
+    return (
+        random_gen.normal(size=(batch_size, state_dimension)).astype(np.float32),
+        random_gen.integers(3, size=batch_size),
+        random_gen.normal(size=(batch_size, state_dimension)).astype(np.float32),
+        random_gen.normal(size=batch_size).astype(np.float32),
+        random_gen.random(size=batch_size) < .01,
+    )
+
+def updates_per_second(train, agent, batch, min_duration=1.):
+    '''
+    A function that calls the given train function on the same batch for at least
+    min_duration seconds and returns the number of updates per second
+    '''
+    num_updates = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_duration:
+        train(agent, batch)
+        num_updates += 1
+    return num_updates / (time.perf_counter() - start)
+
+def benchmark_agent_train(batch_size, state_dimension=17, seed=0, legacy=True):
+    '''
+    A function that compares the per-sample and the batched DQNAgent.train with a DenseModel
+    '''
+    from models import DenseModel
+    from agents import DQNAgent
+
+    random_gen = np.random.default_rng(seed=seed)
+    agent = DQNAgent(DenseModel(input_dimension=state_dimension, output_dimension=3))
+    batch = random_batch(random_gen, batch_size, state_dimension=state_dimension)
+
+    results = {"batch_size": batch_size, "after": updates_per_second(lambda agent, batch: agent.train(batch), agent, batch)}
+    if legacy:
+        results["before"] = updates_per_second(legacy_train, agent, batch)
+    return results
+
+def benchmark_loader_startup(repeats=5, **loader_kwargs):
+    '''
+    A function that measures the TradingDataLoader load time when parsing the csv,
+    when building the columnar cache (cold) and when memory-mapping it (warm)
+    '''
+    import tempfile
+    from loader import TradingDataLoader
+
+    def best_time(**kwargs):
+        durations = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            TradingDataLoader(**loader_kwargs, **kwargs)
+            durations.append(time.perf_counter() - start)
+        return min(durations)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        csv = best_time(cache=False)
+        start = time.perf_counter()
+        TradingDataLoader(**loader_kwargs, cache_dir=cache_dir)
+        cold = time.perf_counter() - start
+        warm = best_time(cache_dir=cache_dir)
+    return {"csv": csv, "cold": cold, "warm": warm}
+
+def benchmark_backtest(data, num_sequences=1_000, seed=0):
+    '''
+    A function that compares scoring random action sequences with the vectorized
+    backtest and with a PortfolioBatch stepped over time
+    '''
+    from environments import TradingBotEnv
+    from portfolio import PortfolioBatch
+    from backtest import backtest
+
+    prices = TradingBotEnv(data).prices_
+    actions = np.random.default_rng(seed=seed).integers(3, size=(num_sequences, len(prices)))
+
+    start = time.perf_counter()
+    backtest(prices, actions)
+    after = time.perf_counter() - start
+
+    start = time.perf_counter()
+    portfolio = PortfolioBatch(num_sequences)
+    for t, price in enumerate(prices):
+        portfolio.apply_action(price, actions[:, t])
+    before = time.perf_counter() - start
+    return {"num_sequences": num_sequences, "before": before, "after": after}
+
+
+def benchmark_policy_inference(data, num_steps=20_000, seed=0):
+    '''
+    A function that measures the greedy single-state latency of DQNAgent.step and the
+    inference throughput of test_dqn_agent, per state and batched
+    '''
+    import io
+    import contextlib
+    import torch
+    from models import DenseModel
+    from agents import DQNAgent
+    from environments import TradingBotEnv
+    from portfolio import Portfolio
+    from runners import test_dqn_agent
+
+    torch.manual_seed(seed)
+    environment, portfolio = TradingBotEnv(data), Portfolio()
+    state_dimension = len(environment.metrics_) + len(portfolio.metrics_)
+    agent = DQNAgent(DenseModel(input_dimension=state_dimension, output_dimension=3), epsilon=0.)
+    state = np.concatenate([environment.get_metrics(), portfolio.get_states()])
+
+    results = {}
+    for key, step in [("latency_before_us", lambda: legacy_policy_step(agent, state)), ("latency_after_us", lambda: agent.step(state))]:
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            step()
+        results[key] = 1e6 * (time.perf_counter() - start) / num_steps
+
+    for key, batched in [("before", False), ("after", True)]:
+        stats = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            test_dqn_agent(agent, environment, portfolio, batched=batched, stats=stats)
+        results[key] = stats["inference_steps_per_sec"]
+    return results
+
+
+# The version of the results format of run_suite
+SUITE_VERSION = 1
+# The relative slowdown over which a result is reported as a regression, by default and
+# for the noisier measures
+REGRESSION_THRESHOLD = .10
+REGRESSION_THRESHOLDS = {"memory.": .05, "episode.": .15}
+
+
+def synthetic_data(data, scale, seed=0):
+    '''
+    A function that returns a frame 'scale' times longer than the given one, continuing its
+    time step. Bars are bootstrapped from the real ones: the open follows a random walk of
+    their log returns, the other prices keep their ratios to the open and the volumes are
+    copied.
+    '''
+    import pandas as pd
+
+    if scale == 1:
+        return data
+    random_gen = np.random.default_rng(seed=seed)
+    length = len(data) * scale
+    rows = random_gen.integers(len(data), size=length)
+    opens = data["open"].to_numpy()
+    log_returns = np.diff(np.log(opens), prepend=np.log(opens[0]))
+    new_opens = opens[0] * np.exp(np.cumsum(log_returns[rows]))
+
+    values = {}
+    for column in data.columns:
+        column_values = data[column].to_numpy()
+        if column in ("high", "low", "close"):
+            values[column] = new_opens * (column_values / opens)[rows]
+        elif column == "open":
+            values[column] = new_opens
+        else:
+            values[column] = column_values[rows]
+    index = pd.date_range(data.index[0], periods=length, freq=data.index[1] - data.index[0], name=data.index.name)
+    return pd.DataFrame(values, index=index).astype(data.dtypes.to_dict())
+
+def calls_per_second(call, min_duration=.5, repeats=3):
+    '''
+    A function that calls a function without arguments for at least min_duration seconds,
+    'repeats' times, and returns the best number of calls per second
+    '''
+    best = 0.
+    for _ in range(repeats):
+        num_calls = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < min_duration:
+            call()
+            num_calls += 1
+        best = max(best, num_calls / (time.perf_counter() - start))
+    return best
+
+def record(results, name, value, unit, higher_is_better=True):
+    '''
+    A function to add a measure to the results of the suite
+    '''
+    results[name] = {"value": float(value), "unit": unit, "higher_is_better": higher_is_better}
+
+def benchmark_micro(data, results, batch_sizes=(32, 256, 4096), memory_size=100_000, seed=0):
+    '''
+    A function that measures the hot paths that do not depend on the data size:
+    portfolio updates, state assembly, replay memories and the agent
+    '''
+    import torch
+    from environments import TradingBotEnv
+    from portfolio import Portfolio, PortfolioBatch
+    from memory import ReplayBuffer, PrioritizedReplayBuffer
+    from models import DenseModel
+    from agents import DQNAgent
+
+    random_gen = np.random.default_rng(seed=seed)
+    environment, portfolio = TradingBotEnv(data), Portfolio()
+    prices = environment.prices_
+    actions = random_gen.integers(3, size=len(prices))
+
+    def apply_actions():
+        portfolio.reset()
+        for price, action in zip(prices, actions):
+            portfolio.apply_action(price, action)
+    record(results, "portfolio.apply_action", len(prices) * calls_per_second(apply_actions, repeats=3), "actions/s")
+
+    portfolios = PortfolioBatch(64)
+    batch_actions = random_gen.integers(3, size=64)
+    record(results, "portfolio_batch.apply_action", 64 * calls_per_second(lambda: portfolios.apply_action(prices[0], batch_actions)), "actions/s")
+
+    env_state = environment.get_metrics()
+    record(results, "state.assemble", calls_per_second(lambda: np.concatenate([env_state, portfolio.get_states()])), "states/s")
+
+    state_dimension = len(environment.metrics_) + len(portfolio.metrics_)
+    for name, memory_class in [("replay", ReplayBuffer), ("prioritized_replay", PrioritizedReplayBuffer)]:
+        memory = memory_class(memory_size, state_dimension, random_gen=np.random.default_rng(seed=seed))
+        transitions = random_batch(random_gen, memory_size, state_dimension=state_dimension)
+        state, new_state = transitions[0][0], transitions[2][0]
+        record(results, f"{name}.add", calls_per_second(lambda: memory.add(state, 1, new_state, 1., False)), "transitions/s")
+        memory.add_batch(*transitions)
+        for batch_size in batch_sizes[:2]:
+            if name == "replay":
+                sample = lambda: memory.sample(batch_size)
+            else:
+                def sample():
+                    _, indices, _ = memory.sample(batch_size)
+                    memory.update_priorities(indices, random_gen.normal(size=batch_size))
+            record(results, f"{name}.sample.b{batch_size}", batch_size * calls_per_second(sample), "transitions/s")
+
+    torch.manual_seed(seed)
+    agent = DQNAgent(DenseModel(input_dimension=state_dimension, output_dimension=3), epsilon=0.)
+    state = np.concatenate([env_state, portfolio.get_states()])
+    record(results, "agent.step", calls_per_second(lambda: agent.step(state)), "steps/s")
+    for batch_size in batch_sizes:
+        batch = random_batch(random_gen, batch_size, state_dimension=state_dimension)
+        record(results, f"agent.train.b{batch_size}", calls_per_second(lambda: agent.train(batch)), "updates/s")
+
+def benchmark_data(data, scale, results):
+    '''
+    A function that measures the environment on a frame: its construction, features
+    included, and its step
+    '''
+    from features import FeatureEngine
+    from environments import TradingBotEnv
+
+    durations = []
+    for _ in range(3):
+        FeatureEngine.memory_cache_.clear()
+        start = time.perf_counter()
+        environment = TradingBotEnv(data, feature_cache_dir=None)
+        durations.append(time.perf_counter() - start)
+    record(results, f"environment.build.x{scale}", min(durations), "s", higher_is_better=False)
+    record(results, f"environment.step.x{scale}", steps_per_second(lambda env: env.step(), environment), "steps/s")
+
+def run_episodes(data, seed=0):
+    '''
+    A function that trains a DQNAgent for one episode and tests it, per state and batched.
+    Returns the wall times in seconds and the peak resident memory of the process in MB.
+    Meant to run in a fresh process so that the peak is the one of the episodes.
+    '''
+    import io
+    import resource
+    import contextlib
+    import torch
+    from environments import TradingBotEnv
+    from portfolio import Portfolio
+    from models import DenseModel
+    from agents import DQNAgent
+    from runners import train_dqn_agent, test_dqn_agent
+
+    torch.manual_seed(seed)
+    environment, portfolio = TradingBotEnv(data, feature_cache_dir=None), Portfolio()
+    agent = DQNAgent(DenseModel(input_dimension=len(environment.metrics_) + len(portfolio.metrics_), output_dimension=3))
+    durations = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, run in [("train", lambda: train_dqn_agent(agent, environment, portfolio, episodes=1, seed=seed)),
+                          ("test", lambda: test_dqn_agent(agent, environment, portfolio)),
+                          ("test_batched", lambda: test_dqn_agent(agent, environment, portfolio, batched=True))]:
+            start = time.perf_counter()
+            run()
+            durations[name] = time.perf_counter() - start
+    # ru_maxrss is in kB on Linux
+    return durations, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def benchmark_episodes(data, scale, results, seed=0):
+    '''
+    A function that measures full train and test episodes on a frame in a spawned process
+    '''
+    import multiprocessing as mp
+
+    with mp.get_context("spawn").Pool(1) as pool:
+        durations, peak_memory = pool.apply(run_episodes, (data, seed))
+    for name, duration in durations.items():
+        record(results, f"episode.{name}.x{scale}", duration, "s", higher_is_better=False)
+    record(results, f"memory.episodes_peak_rss.x{scale}", peak_memory, "MB", higher_is_better=False)
+
+def run_suite(data, scales=(1, 10, 100), episode_scales=None, seed=0):
+    '''
+    A function that runs the whole benchmark suite on the bundled data and on synthetic
+    data scaled from it, offline and on CPU. Full episodes are run on 'episode_scales',
+    all the scales by default. Returns the results with the environment they ran in.
+    '''
+    import sys
+    import platform
+    import torch
+
+    results = {}
+    benchmark_micro(data, results, seed=seed)
+    for scale in scales:
+        scaled_data = synthetic_data(data, scale, seed=seed)
+        benchmark_data(scaled_data, scale, results)
+        if episode_scales is None or scale in episode_scales:
+            benchmark_episodes(scaled_data, scale, results, seed=seed)
+
+    meta = {
+        "version": SUITE_VERSION,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "rows": len(data),
+        "scales": list(scales),
+    }
+    return {"meta": meta, "results": results}
+
+def compare_results(results, baseline, threshold=REGRESSION_THRESHOLD, thresholds=REGRESSION_THRESHOLDS):
+    '''
+    A function that compares the results of two runs of the suite, measure by measure.
+    A measure regresses when it is worse than the baseline by more than its threshold,
+    the one of the longest matching prefix in 'thresholds' or 'threshold'. Returns one
+    row per measure of both runs.
+    '''
+    rows = []
+    for name, measure in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, after = baseline["results"][name]["value"], measure["value"]
+        change = (after - before) / before if before else 0.
+        prefixes = [prefix for prefix in thresholds if name.startswith(prefix)]
+        limit = thresholds[max(prefixes, key=len)] if prefixes else threshold
+        is_regression = (-change if measure["higher_is_better"] else change) > limit
+        rows.append({"name": name, "unit": measure["unit"], "baseline": before, "value": after, "change": change, "regression": is_regression})
+    return rows
+
+def format_comparison(rows):
+    '''
+    A function that formats the rows of compare_results as a table
+    '''
+    lines = [f"{'measure':<36}{'baseline':>14}{'current':>14}{'change':>9}"]
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        lines.append(f"{row['name']:<36}{row['baseline']:>14.4g}{row['value']:>14.4g}{100 * row['change']:>8.1f}% {row['unit']}{flag}")
+    return "\n".join(lines)
+
+def print_legacy_comparisons(data):
+    '''
+    A function that prints the before/after comparisons of the optimized hot paths
+    '''
+    results = benchmark_loader_startup()
+    print(f"TradingDataLoader: csv {1e3 * results['csv']: .1f} ms, cold cache {1e3 * results['cold']: .1f} ms, warm cache {1e3 * results['warm']: .1f} ms")
+
+    results = benchmark_environment_step(data)
+    print(f"TradingBotEnv.step on {len(data)} rows: {results['before']: .0f} -> {results['after']: .0f} steps/sec ({results['speedup']: .1f}x)")
+
+    for num_envs in [1, 64, 1024]:
+        results = benchmark_vector_environment_step(data, num_envs=num_envs)
+        print(f"VectorTradingBotEnv.step with {num_envs} episodes: {results['transitions_per_sec']: .0f} transitions/sec")
+
+    for batch_size in [32, 256, 4096]:
+        results = benchmark_agent_train(batch_size)
+        print(f"DQNAgent.train with batches of {batch_size}: {results['before']: .1f} -> {results['after']: .1f} updates/sec")
+
+    results = benchmark_backtest(data)
+    print(f"Scoring {results['num_sequences']} action sequences: PortfolioBatch loop {results['before']: .2f} s -> backtest {results['after']: .2f} s")
+
+    results = benchmark_policy_inference(data)
+    print(f"DQNAgent.step latency: {results['latency_before_us']: .1f} -> {results['latency_after_us']: .1f} us, test_dqn_agent inference: {results['before']: .0f} -> {results['after']: .0f} steps/sec")
+
+
+if __name__ == "__main__":
+    import sys
+    import json
+    import argparse
+    from loader import TradingDataLoader
+
+    parser = argparse.ArgumentParser(description="Run the benchmark suite and compare it against a baseline")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results")
+    parser.add_argument("--baseline", default=None, help="A results file to compare against")
+    parser.add_argument("--save-baseline", default=None, help="Also write the results to this baseline file")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="The data sizes, in multiples of the bundled csv")
+    parser.add_argument("--episode-scales", type=int, nargs="+", default=None, help="The data sizes to run full episodes on, all by default")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="The default relative regression threshold")
+    parser.add_argument("--legacy", action="store_true", help="Only print the before/after comparisons of the optimized hot paths")
+    args = parser.parse_args()
+
+    data = TradingDataLoader().data()
+    if args.legacy:
+        print_legacy_comparisons(data)
+        sys.exit(0)
+
+    results = run_suite(data, scales=args.scales, episode_scales=args.episode_scales)
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+    for name, measure in results["results"].items():
+        print(f"{name:<36}{measure['value']:>14.4g} {measure['unit']}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare_results(results, baseline, threshold=args.threshold)
+        print(format_comparison(rows))
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
@@ -0,0 +1,84 @@
+'''
+The file that contains the training checkpoints. A checkpoint is a directory with the
+agent (model, target model and optimizer tensors as npz files), the replay memory (one
+.npy file per array, that can be memory-mapped back), the state normalizer (npz), the
+torch random generator state and the runner state in json. No pickle is involved. Checkpoints are written in a
+temporary directory then moved in place, so a crash never leaves a partial one, and
+latest.json points to the last complete one.
+'''
+import os
+import json
+import shutil
+
+import numpy as np
+import torch
+
+from loader import write_json
+
+CHECKPOINT_VERSION = 1
+
+
+def save_checkpoint(root, step, agent, memory=None, state=None, arrays=None, keep=3, normalizer=None):
+    '''
+    A function to write a checkpoint of the training at a given step (e.g. the number of
+    episodes done) under 'root'. 'state' is a json serializable runner state and 'arrays'
+    a dictionary of numpy arrays, e.g. histories. Only the last 'keep' checkpoints are
+    kept. Returns the path of the checkpoint.
+    '''
+    name = f"checkpoint-{step:08d}"
+    tmp_path = os.path.join(root, f".{name}.tmp{os.getpid()}")
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    agent.save(os.path.join(tmp_path, "agent"))
+    if memory is not None:
+        memory.save(os.path.join(tmp_path, "memory"))
+    if normalizer is not None:
+        normalizer.save(os.path.join(tmp_path, "normalizer.npz"))
+    np.save(os.path.join(tmp_path, "torch_rng.npy"), torch.get_rng_state().numpy())
+    np.savez(os.path.join(tmp_path, "arrays.npz"), **(arrays or {}))
+    write_json(os.path.join(tmp_path, "checkpoint.json"),
+               {"version": CHECKPOINT_VERSION, "step": step, "memory": memory is not None, "normalizer": normalizer is not None,
+                "state": state or {}})
+
+    path = os.path.join(root, name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    write_json(os.path.join(root, "latest.json"), {"name": name, "step": step})
+
+    names = sorted(name for name in os.listdir(root) if name.startswith("checkpoint-"))
+    for name in names[:-keep] if keep else []:
+        shutil.rmtree(os.path.join(root, name))
+    return path
+
+def latest_checkpoint(root):
+    '''
+    A function that returns the path of the last complete checkpoint under 'root', None
+    if there is none
+    '''
+    latest_path = os.path.join(root, "latest.json")
+    if not os.path.exists(latest_path):
+        return None
+    with open(latest_path) as f:
+        return os.path.join(root, json.load(f)["name"])
+
+def load_checkpoint(path, agent, memory=None, normalizer=None):
+    '''
+    A function to restore the agent, the memory, the normalizer and the torch random
+    generator from a checkpoint in place. Returns the runner state and the arrays saved with it.
+    '''
+    with open(os.path.join(path, "checkpoint.json")) as f:
+        meta = json.load(f)
+    assert meta["version"] == CHECKPOINT_VERSION, f"Unsupported checkpoint version {meta['version']}"
+
+    agent.load(os.path.join(path, "agent"))
+    if memory is not None and meta["memory"]:
+        memory.load(os.path.join(path, "memory"))
+    if normalizer is not None and meta.get("normalizer", False):
+        normalizer.load(os.path.join(path, "normalizer.npz"))
+    torch.set_rng_state(torch.from_numpy(np.load(os.path.join(path, "torch_rng.npy"))))
+    with np.load(os.path.join(path, "arrays.npz")) as values:
+        arrays = {key: values[key] for key in values.files}
+    return meta["state"], arrays
@@ -0,0 +1,167 @@
+'''
+The file that contains the multi-pair, multi-timeframe data store. The bars of many pairs
+are aligned on one time index and kept in a memory-mapped (pairs, time, fields) panel per
+time step, so that date range queries only touch the requested rows and coarser time
+steps are resampled once from the base panel then cached on disk.
+'''
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from loader import TradingDataLoader, write_json, current_version, new_version, commit_version
+
+FIELDS = ["open", "high", "low", "close", "volume", "volume_quote", "tradecount"]
+# How every field is aggregated when resampling to a coarser time step
+AGGREGATIONS = {"open": "first", "high": "max", "low": "min", "close": "last", "volume": "sum", "volume_quote": "sum", "tradecount": "sum"}
+# The pandas frequencies of the time steps used in the file names
+TIME_STEPS = {"minute": "1min", "hourly": "1h", "daily": "1D"}
+
+
+class TradingDataStore:
+    '''
+    A store of aligned (pairs, time, fields) panels under 'root'. Missing bars are NaN.
+    '''
+    def __init__(self, root="./data/store"):
+        self.root_ = root
+        self.meta_ = None
+        self.panels_ = {}
+        meta_path = os.path.join(root, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta_ = json.load(f)
+
+    def pairs(self):
+        '''
+        A method that returns the pairs of the store
+        '''
+        return list(self.meta_["pairs"])
+
+    def ingest(self, crypto_pairs, time_step="hourly", data_dir="./data"):
+        '''
+        A method to build the base panel of the store from the csv files of the given pairs.
+        Pairs are read one at a time through the TradingDataLoader cache and written into a
+        memory-mapped panel, so only one pair is ever in memory.
+        '''
+        def load(pair):
+            return TradingDataLoader(pair, time_step, start_date=None, end_date=None, data_dir=data_dir).data()
+
+        # Align every pair on the union of their dates
+        index = np.array([], dtype=np.int64)
+        for pair in crypto_pairs:
+            index = np.union1d(index, load(pair).index.to_numpy(dtype="datetime64[ns]").view(np.int64))
+
+        tmp_path = self.__tmp_path(time_step)
+        panel = np.lib.format.open_memmap(os.path.join(tmp_path, "panel.npy"), mode="w+", dtype=np.float64,
+                                          shape=(len(crypto_pairs), len(index), len(FIELDS)))
+        for i, pair in enumerate(crypto_pairs):
+            frame = load(pair)
+            assert len(frame.columns) == len(FIELDS), f"Unexpected columns for {pair}: {list(frame.columns)}"
+            positions = np.searchsorted(index, frame.index.to_numpy(dtype="datetime64[ns]").view(np.int64))
+            panel[i] = np.nan
+            panel[i, positions] = frame.to_numpy(dtype=np.float64)
+        panel.flush()
+        del panel
+        np.save(os.path.join(tmp_path, "index.npy"), index)
+
+        version = (self.meta_ or {}).get("version", 0) + 1
+        self.__commit(time_step, tmp_path, {"time_step": time_step, "version": version})
+        self.meta_ = {"pairs": list(crypto_pairs), "fields": FIELDS, "base": time_step, "version": version}
+        write_json(os.path.join(self.root_, "meta.json"), self.meta_)
+        self.panels_ = {}
+
+    def panel(self, time_step=None):
+        '''
+        A method that returns the dates and the memory-mapped panel of a time step,
+        resampling it from the base panel the first time it is requested
+        '''
+        assert self.meta_ is not None, "The store is empty, ingest some pairs first"
+        time_step = time_step or self.meta_["base"]
+        if time_step not in self.panels_:
+            path = current_version(os.path.join(self.root_, time_step))
+            meta = None
+            if path is not None:
+                with open(os.path.join(path, "meta.json")) as f:
+                    meta = json.load(f)
+            if meta is None or meta["version"] != self.meta_["version"]:
+                assert time_step != self.meta_["base"], "The base panel is missing, ingest the pairs again"
+                path = self.__resample(time_step)
+            index = pd.DatetimeIndex(np.load(os.path.join(path, "index.npy")).view("datetime64[ns]"), name="date")
+            self.panels_[time_step] = (index, np.load(os.path.join(path, "panel.npy"), mmap_mode="r"))
+        return self.panels_[time_step]
+
+    def query(self, start_date=None, end_date=None, crypto_pairs=None, fields=None, time_step=None):
+        '''
+        A method that returns the dates and the (pairs, time, fields) values between two
+        dates, both included. Without pair or field selection the values are a view on the
+        memory-mapped panel, nothing is read before it is used.
+        '''
+        index, panel = self.panel(time_step)
+        start = 0 if start_date is None else index.searchsorted(pd.Timestamp(start_date), side="left")
+        end = len(index) if end_date is None else index.searchsorted(pd.Timestamp(end_date), side="right")
+        values = panel[:, start:end]
+        if crypto_pairs is not None:
+            values = values[[self.meta_["pairs"].index(pair) for pair in crypto_pairs]]
+        if fields is not None:
+            values = values[..., [FIELDS.index(field) for field in fields]]
+        return index[start:end], values
+
+    def frame(self, crypto_pair, start_date=None, end_date=None, time_step=None):
+        '''
+        A method that returns the bars of one pair between two dates as a data frame with
+        the columns of TradingDataLoader, e.g. 'volume ETH' and 'volume USDT' for ETH/USDT.
+        Dates without a bar for this pair are dropped.
+        '''
+        dates, values = self.query(start_date, end_date, crypto_pairs=[crypto_pair], time_step=time_step)
+        base, quote = crypto_pair.split("/")
+        columns = FIELDS[:4] + [f"volume {base}", f"volume {quote}", "tradecount"]
+        df = pd.DataFrame(values[0], index=dates, columns=columns)
+        df = df[~np.isnan(values[0]).all(axis=1)]
+        return df.astype({"tradecount": np.int64})
+
+    def __resample(self, time_step):
+        '''
+        A private method to resample the base panel to a coarser time step, one pair at a
+        time, and cache the result on disk. Returns the directory of the new panel.
+        '''
+        index, panel = self.panel(self.meta_["base"])
+        rule = TIME_STEPS.get(time_step, time_step)
+        new_index = pd.Series(0, index=index).resample(rule).size().index
+
+        tmp_path = self.__tmp_path(time_step)
+        new_panel = np.lib.format.open_memmap(os.path.join(tmp_path, "panel.npy"), mode="w+", dtype=np.float64,
+                                              shape=(panel.shape[0], len(new_index), len(FIELDS)))
+        for i in range(panel.shape[0]):
+            resampler = pd.DataFrame(panel[i], index=index, columns=FIELDS).resample(rule)
+            for j, field in enumerate(FIELDS):
+                how = AGGREGATIONS[field]
+                values = resampler[field].sum(min_count=1) if how == "sum" else getattr(resampler[field], how)()
+                new_panel[i, :, j] = values.reindex(new_index).to_numpy()
+        new_panel.flush()
+        del new_panel
+        np.save(os.path.join(tmp_path, "index.npy"), new_index.to_numpy(dtype="datetime64[ns]").view(np.int64))
+        return self.__commit(time_step, tmp_path, {"time_step": time_step, "rule": rule, "version": self.meta_["version"]})
+
+    def __tmp_path(self, time_step):
+        '''
+        A private method that returns a fresh temporary directory to write a panel in
+        '''
+        return new_version(os.path.join(self.root_, time_step))
+
+    def __commit(self, time_step, tmp_path, meta):
+        '''
+        A private method to make a fully written panel the current version of its time
+        step, see loader.commit_version. Returns its directory.
+        '''
+        write_json(os.path.join(tmp_path, "meta.json"), meta)
+        self.panels_.pop(time_step, None)
+        return commit_version(os.path.join(self.root_, time_step), tmp_path)
+
+
+if __name__ == "__main__":
+    store = TradingDataStore()
+    store.ingest(["ETH/USDT"])
+    dates, values = store.query("2021-01-01", "2021-01-31 23:00:00", time_step="4h")
+    print(values.shape)
+    print(store.frame("ETH/USDT", "2021-01-01", "2021-01-07", time_step="daily"))
@@ -2,30 +2,96 @@ import numpy as np
 import matplotlib.pyplot as plt
 from utils import generate_rgb_color
 
+def min_max_indices(values, num_points):
+    '''
+    A function that returns the sorted indices of the minimum and the maximum of
+    'num_points' / 2 equal buckets of values, plus the first and last ones, so that a
+    downsampled line keeps every peak and trough
+    '''
+    values = np.asarray(values)
+    num_buckets = max(num_points // 2, 1)
+    if len(values) <= max(num_points, 2):
+        return np.arange(len(values))
+    # The first buckets are one value larger when the values do not divide evenly
+    size, remainder = divmod(len(values), num_buckets)
+    body = values[:remainder * (size + 1)].reshape(remainder, size + 1), values[remainder * (size + 1):].reshape(-1, size)
+    offsets = np.arange(num_buckets) * size + np.minimum(np.arange(num_buckets), remainder)
+    minima = np.concatenate([np.argmin(bucket, axis=1) for bucket in body]) + offsets
+    maxima = np.concatenate([np.argmax(bucket, axis=1) for bucket in body]) + offsets
+    return np.unique(np.concatenate([[0], minima, maxima, [len(values) - 1]]))
+
+def lttb_indices(values, num_points, candidates=None):
+    '''
+    A function that returns the sorted indices of 'num_points' values picked by Largest
+    Triangle Three Buckets: the first and last values, then in every bucket the value
+    making the largest triangle with the point picked in the previous bucket and the mean
+    of the next bucket. Only the 'candidates' indices are considered if given, e.g. a
+    min_max_indices preselection (MinMaxLTTB), which keeps the loop short.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    x = np.arange(len(values)) if candidates is None else np.asarray(candidates)
+    y = values[x]
+    if len(x) <= max(num_points, 2):
+        return x
+    bounds = np.linspace(1, len(x) - 1, num_points - 1).astype(np.int64)
+    means_x = np.add.reduceat(x[:-1].astype(np.float64), bounds[:-1]) / np.diff(bounds)
+    means_y = np.add.reduceat(y[:-1], bounds[:-1]) / np.diff(bounds)
+    means_x, means_y = np.append(means_x[1:], x[-1]), np.append(means_y[1:], y[-1])
+    picked = np.empty(num_points, dtype=np.int64)
+    picked[0], picked[-1] = 0, len(x) - 1
+    for bucket in range(num_points - 2):
+        start, end = bounds[bucket], bounds[bucket + 1]
+        previous = picked[bucket]
+        areas = np.abs((x[previous] - means_x[bucket]) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (means_y[bucket] - y[previous]))
+        picked[bucket + 1] = start + np.argmax(areas)
+    return x[picked]
+
+def downsample_indices(values, num_points=2_000, method="minmax"):
+    '''
+    A function that returns the indices of at most about 'num_points' values of a line to
+    plot: "minmax" keeps the extrema of every bucket, "lttb" the visually most significant
+    point of every bucket, and "minmax_lttb" runs LTTB on a min/max preselection of 4 times
+    as many points, which is as fast as "minmax" on long lines. None keeps every value.
+    '''
+    if method is None or len(values) <= num_points:
+        return np.arange(len(values))
+    if method == "minmax":
+        return min_max_indices(values, num_points)
+    if method == "lttb":
+        return lttb_indices(values, num_points)
+    if method == "minmax_lttb":
+        return lttb_indices(values, num_points, candidates=min_max_indices(values, 4 * num_points))
+    raise ValueError(f"Unknown downsampling method {method}")
+
 def plot_history_against_xchange_rates(
     history,
     xchange_data,
     investment_return=.0,
     color_seed=866549187,
-    save_path=None):
+    save_path=None,
+    num_points=2_000,
+    downsampling="minmax"):
     '''
     A function that plots the history of portfolio values for all epsiodes
-    against the values of the exchange rate
+    against the values of the exchange rate. Every line is downsampled to about
+    'num_points' points, see downsample_indices.
     '''
     random_gen = np.random.default_rng(seed=color_seed)
 
     # Get xchange useful data
     dates = xchange_data.index
-    exchange_rates = xchange_data['open']
+    exchange_rates = xchange_data['open'].to_numpy()
 
     # Primary plot
     _, ax1 = plt.subplots()
 
-    if isinstance(history, dict):
-        for episode, values in history.items():
-            ax1.plot(dates[::24], values[::24], color=generate_rgb_color(random_gen), linewidth=1, label=f"episode {episode + 1}")
-    else:
-        ax1.plot(dates[::24], history[::24], color=generate_rgb_color(random_gen), linewidth=1, label="Test episode")
+    episodes = history.items() if isinstance(history, dict) else [(None, history)]
+    for episode, values in episodes:
+        values = np.asarray(values)
+        indices = downsample_indices(values, num_points, downsampling)
+        label = "Test episode" if episode is None else f"episode {episode + 1}"
+        ax1.plot(dates[indices], values[indices], color=generate_rgb_color(random_gen), linewidth=1, label=label)
 
     ax1.set_xlabel("Time")
     ax1.set_ylabel("Portfolio value (USD)", rotation=90, labelpad=40)
@@ -33,7 +99,8 @@ def plot_history_against_xchange_rates(
 
     # Secondary plot
     ax2 = ax1.twinx()
-    ax2.plot(np.arange(dates[::24].shape[0]), exchange_rates[::24], color="black", label="X-change rate", linestyle='dashed')
+    indices = downsample_indices(exchange_rates, num_points, downsampling)
+    ax2.plot(dates[indices], exchange_rates[indices], color="black", label="X-change rate", linestyle='dashed')
     ax2.set_ylabel("X-change rate", rotation=270, labelpad=40)
     ax2.legend()
 
@@ -48,10 +115,14 @@ def plot_history_against_xchange_rates(
 if __name__ =="__main__":
     import pickle as pk
     from loader import TradingDataLoader
+    from history import load_history
 
     data = TradingDataLoader().data()
-    with open('./training_history/temp.pkl', "rb") as f:
-        pickler = pk.Unpickler(f)
-        portfolio_history = pickler.load()
+    try:
+        portfolio_history = load_history('./training_history/temp.npz')
+    except FileNotFoundError:
+        with open('./training_history/temp.pkl', "rb") as f:
+            pickler = pk.Unpickler(f)
+            portfolio_history = pickler.load()
 
     plot_history_against_xchange_rates(portfolio_history, data)
@@ -1,4 +1,7 @@
 import numpy as np
+import pandas as pd
+
+from features import FeatureEngine
 
 METRICS = ["open", "high", "low", "close", "volume ETH", "volume USDT", "tradecount"]
 
@@ -36,12 +39,23 @@ class TradingBotEnv(BaseEnv):
     exchange rates, ...
     '''
 
-    def __init__(self, data, metrics=METRICS, lookback_window_size=20):
+    def __init__(self, data, metrics=METRICS, lookback_window_size=20, dtype=np.float64, features=None, indicators=None,
+                 feature_cache_dir=None, observation_window=None):
+        '''
+        Initialize object. 'features' is an optional precomputed (time, metrics + derived
+        metrics) matrix, e.g. the features_ of another environment over the same data
+        living in shared memory, that is then used as is instead of being recomputed.
+        'indicators' are the (name, params) specs of the registered features derived from
+        the data (see features.py), Bollinger bands over the lookback window by default.
+        With an 'observation_window' k, observations are the (k, features) windows of the
+        last k rows instead of single rows, see windows_. With a 'feature_cache_dir', e.g.
+        features.FEATURE_CACHE_DIR, the derived features are cached on disk there.
+        '''
         super().__init__()
         assert "open" in metrics, "You need at least an 'open' price in your metrics"
         self.lookback_window_size_ = lookback_window_size
-        self.metrics_ = metrics
-        self.market_data_ = data[metrics]
+        self.metrics_ = list(metrics)
+        self.market_data_ = data[self.metrics_]
         self.length_ = len(data)
         self.current_index_ = 0
 
@@ -50,32 +64,47 @@ class TradingBotEnv(BaseEnv):
         self.is_done_ = np.zeros(len(self.market_data_), dtype=bool)
         self.is_done_[-1] = True
 
-        ### Derive some new features from the data
-        self.rolling_mean_ = self.market_data_["open"].rolling(window=self.lookback_window_size_, center=False, min_periods=0).mean()
-        self.rolling_std_ = self.market_data_["open"].rolling(window=self.lookback_window_size_, center=False, min_periods=0).std()
-        self.rolling_std_ = self.rolling_std_.fillna(value=self.rolling_std_.iloc[1])
-        self.upper_band_, self.lower_band_ = self.rolling_mean_ + 2 * self.rolling_std_, self.rolling_mean_ - 2 * self.rolling_std_
+        if indicators is None:
+            indicators = [("bollinger", {"window": lookback_window_size})]
+        self.feature_engine_ = FeatureEngine(indicators, cache_dir=feature_cache_dir)
+        self.metrics_ += self.feature_engine_.names()
+        self.metric_index_ = {metric: i for i, metric in enumerate(self.metrics_)}
+
+        if features is not None:
+            assert features.shape == (self.length_, len(self.metrics_)), "The features should have one column per metric and derived metric"
+            self.features_ = features
+        else:
+            ### Derive the new features from the data, then materialize every feature once
+            ### in a contiguous (time, metric) matrix so that the hot path only does numpy
+            ### indexing instead of pandas lookups
+            derived = self.feature_engine_.compute(self.market_data_)
+            self.features_ = np.empty((self.length_, len(self.metrics_)), dtype=dtype)
+            for metric, i in self.metric_index_.items():
+                column = self.market_data_[metric] if metric in self.market_data_.columns else derived[metric]
+                self.features_[:, i] = column.to_numpy(dtype=dtype)
+
+        ### The lookback windows are strided views on the feature matrix, whose first row
+        ### is repeated before it so that the first windows are full
+        self.observation_window_ = observation_window
+        self.windows_ = None
+        if observation_window:
+            padded = np.empty((observation_window - 1 + self.length_, len(self.metrics_)), dtype=self.features_.dtype)
+            padded[:observation_window - 1] = self.features_[:1]
+            padded[observation_window - 1:] = self.features_
+            self.features_ = padded[observation_window - 1:]
+            self.windows_ = np.lib.stride_tricks.sliding_window_view(padded, observation_window, axis=0).transpose(0, 2, 1)
+        self.prices_ = self.features_[:, self.metric_index_["open"]]
 
         ### Create the state dictionnary
-        self.state_dict_ = {}
-        for column_name in self.market_data_.columns:
-            self.state_dict_[column_name] = self.market_data_[column_name]
-        self.state_dict_["rolling_mean"] = self.rolling_mean_
-        self.state_dict_["rolling_std"] = self.rolling_std_
-        self.state_dict_["upper_band"] = self.upper_band_
-        self.state_dict_["lower_band"] = self.lower_band_
-        self.state_dict_["price_over_sma"] = self.market_data_["open"]/self.rolling_mean_
-
-        self.metrics_ += ["rolling_mean", "rolling_std", "upper_band", "lower_band", "price_over_sma"]
-        
+        self.state_dict_ = {metric: pd.Series(self.features_[:, i], index=data.index, copy=False) for metric, i in self.metric_index_.items()}
+
     def step(self):
         '''
-        Method to take a step in the environment
+        Method to take a step in the environment. The observation is a view on the
+        row of the feature matrix at the current index, or on its window.
         '''
         is_done = self.is_done_[self.current_index_]
-        observation = []
-        for metric in self.metrics_:
-            observation.append(self.state_dict_[metric][self.current_index_])
+        observation = self.features_[self.current_index_] if self.windows_ is None else self.windows_[self.current_index_]
         if not is_done:
             self.current_index_ += 1
         return is_done, observation
@@ -107,31 +136,40 @@ class TradingBotEnv(BaseEnv):
         '''
         A method to get the current opening price
         '''
-        return self.state_dict_["open"][self.current_index_]
+        return self.prices_[self.current_index_]
     
     def get_final_price(self):
         '''
         A method to get the final opening price
         '''
-        return self.state_dict_["open"][-1]
+        return self.prices_[-1]
     
     def get_price_at(self, index):
         '''
         A method to get the opening price at a given index
         '''
         if index < 0:
-            return self.state_dict_["open"][0]
+            return self.prices_[0]
         if index >= self.length_:
             return self.get_final_price()
-        return self.state_dict_["open"][index]
+        return self.prices_[index]
 
     def get_metrics(self, metrics=None):
         '''
-        A method to get the metrics at the current index
+        A method to get the metrics at the current index, or their window
         '''
+        observation = self.features_[self.current_index_] if self.windows_ is None else self.windows_[self.current_index_]
         if not metrics:
-            metrics = self.metrics_
-        return np.array([self.state_dict_[metric][self.current_index_] for metric in metrics])
+            return observation
+        return observation[..., [self.metric_index_[metric] for metric in metrics]]
+
+    def get_observations(self, indices):
+        '''
+        A method that returns the observations at the given indices as flat rows
+        '''
+        if self.windows_ is None:
+            return self.features_[indices]
+        return self.windows_[indices].reshape(len(indices), -1)
 
     def plot(self, metrics=None):
         '''
@@ -149,6 +187,215 @@ class TradingBotEnv(BaseEnv):
         ax.legend(metrics)
         plt.show()
 
+class VectorTradingBotEnv(BaseEnv):
+    '''
+    A batch of N independent episodes over the feature matrix of a single TradingBotEnv.
+    Every episode has its own cursor, start and end index, so that one numpy call steps
+    all of them at once. The features are shared, not copied.
+    '''
+
+    def __init__(self, environment, num_envs=None, starts=None, ends=None, windows=None):
+        super().__init__()
+        self.environment_ = environment
+        self.features_ = environment.features_
+        self.prices_ = environment.prices_
+        self.metrics_ = environment.metrics_
+        self.lookback_window_size_ = environment.lookback_window_size_
+        self.action_space_ = environment.action_space_
+        # Map the actions (hold, buy, sell) to the sign used in the reward
+        self.action_signs_ = np.array([0., 1., -1.])
+
+        if windows is not None:
+            starts, ends = self.get_window_bounds(windows)
+        if starts is None:
+            starts = np.zeros(num_envs or 1, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        if ends is None:
+            ends = np.full(len(starts), environment.length_ - 1, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+
+        assert starts.shape == ends.shape, "There should be as many start as end indices"
+        assert np.all((0 <= starts) & (starts <= ends) & (ends < environment.length_)), "Episode bounds out of the data range"
+
+        self.num_envs_ = len(starts)
+        self.starts_ = starts
+        self.ends_ = ends
+        self.current_index_ = starts.copy()
+
+    def get_window_bounds(self, windows):
+        '''
+        A method to convert (start_date, end_date) windows into inclusive start and end
+        indices of the feature matrix
+        '''
+        dates = self.environment_.market_data_.index
+        starts = np.array([dates.searchsorted(start_date, side="left") for start_date, _ in windows], dtype=np.int64)
+        ends = np.array([dates.searchsorted(end_date, side="right") - 1 for _, end_date in windows], dtype=np.int64)
+        return starts, ends
+
+    def step(self, actions):
+        '''
+        Method to take a step in every episode. Returns the done flags, the stacked
+        observations of shape (N, metrics) and the rewards of the given actions.
+        '''
+        is_done = self.current_index_ == self.ends_
+        observations = self.features_[self.current_index_]
+        self.current_index_ += ~is_done
+        return is_done, observations, self.get_reward(actions)
+
+    def get_reward(self, actions):
+        '''
+        A method to get the reward values of an array of actions, same formula as
+        TradingBotEnv.get_reward
+        '''
+        actions = np.asarray(actions)
+        assert np.all((0 <= actions) & (actions < len(self.action_space_))), f"You cannot take an action that's not one of: {self.action_space_}"
+        a = self.action_signs_[actions]
+
+        price_t = self.prices_[self.current_index_]
+        price_t_minus_1 = self.get_price_at(self.current_index_ - 1)
+        price_t_minus_n = self.get_price_at(self.current_index_ - self.lookback_window_size_)
+
+        return (1 + a*(price_t - price_t_minus_1)/price_t_minus_1)*price_t_minus_1/price_t_minus_n
+
+    def reset(self, mask=None):
+        '''
+        A public method to reset all the episodes, or only the ones selected by a
+        boolean mask
+        '''
+        if mask is None:
+            self.current_index_[:] = self.starts_
+        else:
+            self.current_index_[mask] = self.starts_[mask]
+
+    def get_current_price(self):
+        '''
+        A method to get the current opening price of every episode
+        '''
+        return self.prices_[self.current_index_]
+
+    def get_price_at(self, indices):
+        '''
+        A method to get the opening prices at the given indices, clipped to the
+        bounds of every episode
+        '''
+        return self.prices_[np.clip(indices, self.starts_, self.ends_)]
+
+    def get_metrics(self):
+        '''
+        A method to get the metrics at the current index of every episode
+        '''
+        return self.features_[self.current_index_]
+
+class StreamingTradingBotEnv(BaseEnv):
+    '''
+    The live / paper-trading environment. It starts from a history of bars, then bars
+    pushed from a feed are appended one at a time: their derived features are updated
+    incrementally and only the last 'capacity' bars are kept, in a preallocated ring, so
+    that the cost of a new bar does not grow over time. A stream only goes forward: it is
+    run with runners.run_live, not with the episode runners that reset their environment.
+    '''
+
+    def __init__(self, history, metrics=METRICS, lookback_window_size=20, dtype=np.float64, indicators=None, capacity=10_000,
+                 feature_cache_dir=None):
+        super().__init__()
+        assert "open" in metrics, "You need at least an 'open' price in your metrics"
+        assert len(history) > 0, "The environment needs at least one bar of history"
+        assert capacity > lookback_window_size, "The capacity should be larger than the lookback window"
+        self.lookback_window_size_ = lookback_window_size
+        self.base_metrics_ = list(metrics)
+        self.capacity_ = capacity
+        self.action_space_ = np.array([0, 1, 2])
+
+        if indicators is None:
+            indicators = [("bollinger", {"window": lookback_window_size})]
+        self.feature_engine_ = FeatureEngine(indicators, cache_dir=feature_cache_dir)
+        self.metrics_ = self.base_metrics_ + self.feature_engine_.names()
+        self.metric_index_ = {metric: i for i, metric in enumerate(self.metrics_)}
+        self.open_index_ = self.metric_index_["open"]
+
+        # Warm the features up on the history and keep its last bars in the ring
+        market_data = history[self.base_metrics_]
+        derived = self.feature_engine_.compute(market_data)
+        self.feature_engine_.warm_up()
+        self.features_ = np.zeros((capacity, len(self.metrics_)), dtype=dtype)
+        tail = min(capacity, len(history))
+        self.features_[:tail, :len(self.base_metrics_)] = market_data.to_numpy(dtype=dtype)[-tail:]
+        self.features_[:tail, len(self.base_metrics_):] = derived.to_numpy(dtype=dtype)[-tail:]
+        self.features_ = np.roll(self.features_, len(history) - tail, axis=0)
+        self.length_ = len(history)
+        self.current_index_ = self.length_ - 1
+        self.last_date_ = history.index[-1]
+
+    def push(self, bar):
+        '''
+        A method to append a new bar, a mapping with (at least) the base metrics and
+        optionally a 'date'. Returns the observation of the bar.
+        '''
+        row = self.features_[self.length_ % self.capacity_]
+        num_base = len(self.base_metrics_)
+        for i, metric in enumerate(self.base_metrics_):
+            row[i] = bar[metric]
+        row[num_base:] = self.feature_engine_.append(bar)
+        self.length_ += 1
+        self.current_index_ = self.length_ - 1
+        self.last_date_ = bar.get("date", self.last_date_)
+        return row
+
+    def step(self):
+        '''
+        Method to take a step in the environment: the observation of the last pushed bar.
+        A stream is never done.
+        '''
+        return False, self.get_metrics()
+
+    def get_reward(self, action):
+        '''
+        A method to get the reward value from a specific action, same formula as
+        TradingBotEnv.get_reward
+        '''
+        assert action in self.action_space_, f"You cannot take an action that's not one of: {self.action_space_}"
+        a = 0
+        if action == 1:
+            a = 1
+        elif action == 2:
+            a = -1
+
+        price_t = self.get_current_price()
+        price_t_minus_1 = self.get_price_at(self.current_index_ - 1)
+        price_t_minus_n = self.get_price_at(self.current_index_ - self.lookback_window_size_)
+
+        return (1 + a*(price_t - price_t_minus_1)/price_t_minus_1)*price_t_minus_1/price_t_minus_n
+
+    def reset(self):
+        '''
+        A stream cannot be replayed, see runners.run_live to trade on it
+        '''
+        raise RuntimeError("A StreamingTradingBotEnv cannot be reset: it only goes forward with the pushed bars, "
+                           "run it with runners.run_live instead of an episode runner")
+
+    def get_current_price(self):
+        '''
+        A method to get the opening price of the last bar
+        '''
+        return self.features_[self.current_index_ % self.capacity_, self.open_index_]
+
+    def get_price_at(self, index):
+        '''
+        A method to get the opening price at a given index, clipped to the bars still in
+        the ring
+        '''
+        index = min(max(index, 0, self.length_ - self.capacity_), self.length_ - 1)
+        return self.features_[index % self.capacity_, self.open_index_]
+
+    def get_metrics(self, metrics=None):
+        '''
+        A method to get the metrics of the last bar
+        '''
+        row = self.features_[self.current_index_ % self.capacity_]
+        if not metrics:
+            return row
+        return row[[self.metric_index_[metric] for metric in metrics]]
+
 if __name__ == "__main__":
     from loader import TradingDataLoader
     
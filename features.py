@@ -0,0 +1,414 @@
+'''
+The file that contains the feature engine of the environments. Every feature (Bollinger
+bands, EMA, MACD, RSI, ATR, volume z-score...) is registered by name, computes its columns
+over a whole data frame at once and can then be updated in O(1) when a new bar arrives.
+Batch results are cached in memory (the last few) and, if asked, on disk, keyed by the data
+and the parameters, so that environments over the same data compute them only once.
+'''
+import os
+import json
+import math
+import hashlib
+from collections import deque, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# A disk cache location for callers that opt in, relative to the working directory
+FEATURE_CACHE_DIR = "./data/.cache/features"
+# The number of batch results kept in memory by every process
+MEMORY_CACHE_SIZE = 4
+
+# The registered feature classes by name, see register_feature
+FEATURES = {}
+
+
+def register_feature(name):
+    '''
+    A decorator that registers a feature class under a name usable in the engine specs
+    '''
+    def decorator(cls):
+        FEATURES[name] = cls
+        return cls
+    return decorator
+
+
+class BaseFeature:
+    '''
+    A base class with the methods to implement when defining a feature. compute() returns
+    the columns over a whole frame and leaves the feature ready to update() with the bars
+    that follow it.
+    '''
+    def __init__(self, **params):
+        self.params_ = params
+
+    def names(self):
+        '''
+        A method that returns the names of the columns of the feature
+        '''
+        raise NotImplementedError
+
+    def compute(self, data):
+        '''
+        A method to compute the columns over a data frame, as a dictionary of arrays
+        '''
+        raise NotImplementedError
+
+    def update(self, bar):
+        '''
+        A method to compute the columns of a new bar, given as a mapping of the data columns,
+        in O(1) from the internal state
+        '''
+        raise NotImplementedError
+
+
+class RollingWindow:
+    '''
+    Running mean and variance over the last 'window' values (Welford's algorithm with
+    removal of the value leaving the window), O(1) per new value
+    '''
+    def __init__(self, window):
+        self.window_ = window
+        self.values_ = deque()
+        self.mean_ = 0.
+        self.m2_ = 0.
+
+    def push(self, value):
+        '''
+        A method to add a value and drop the oldest one once the window is full
+        '''
+        if len(self.values_) == self.window_:
+            old = self.values_.popleft()
+            if self.values_:
+                delta = old - self.mean_
+                self.mean_ -= delta / len(self.values_)
+                self.m2_ -= delta * (old - self.mean_)
+            else:
+                self.mean_, self.m2_ = 0., 0.
+        self.values_.append(value)
+        delta = value - self.mean_
+        self.mean_ += delta / len(self.values_)
+        self.m2_ += delta * (value - self.mean_)
+
+    def fill(self, values):
+        '''
+        A method to reset the window with the last values of a series
+        '''
+        self.values_.clear()
+        self.mean_, self.m2_ = 0., 0.
+        for value in values[-self.window_:]:
+            self.push(float(value))
+
+    def std(self):
+        '''
+        A method that returns the sample standard deviation, NaN with fewer than 2 values
+        '''
+        if len(self.values_) < 2:
+            return math.nan
+        return math.sqrt(max(self.m2_, 0.) / (len(self.values_) - 1))
+
+
+def ewm(values, alpha):
+    '''
+    A function that returns the exponentially weighted mean y_t = (1 - alpha) y_t-1 + alpha x_t,
+    starting with y_0 = x_0
+    '''
+    return pd.Series(values).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+
+
+@register_feature("bollinger")
+class BollingerBands(BaseFeature):
+    '''
+    The rolling mean and standard deviation of a column over 'window' bars, the bands two
+    standard deviations away and the ratio of the column over its mean
+    '''
+    def __init__(self, window=20, column="open"):
+        super().__init__(window=window, column=column)
+        self.window_ = window
+        self.column_ = column
+        self.rolling_ = RollingWindow(window)
+
+    def names(self):
+        return ["rolling_mean", "rolling_std", "upper_band", "lower_band", "price_over_sma"]
+
+    def compute(self, data):
+        values = data[self.column_]
+        rolling_mean = values.rolling(window=self.window_, center=False, min_periods=0).mean()
+        rolling_std = values.rolling(window=self.window_, center=False, min_periods=0).std()
+        if len(rolling_std) > 1:
+            rolling_std = rolling_std.fillna(value=rolling_std.iloc[1])
+        self.rolling_.fill(values.to_numpy(dtype=np.float64))
+        return {
+            "rolling_mean": rolling_mean.to_numpy(),
+            "rolling_std": rolling_std.to_numpy(),
+            "upper_band": (rolling_mean + 2 * rolling_std).to_numpy(),
+            "lower_band": (rolling_mean - 2 * rolling_std).to_numpy(),
+            "price_over_sma": (values / rolling_mean).to_numpy(),
+        }
+
+    def update(self, bar):
+        value = float(bar[self.column_])
+        self.rolling_.push(value)
+        rolling_mean = self.rolling_.mean_
+        # A single bar has no deviation yet, a batch fills it with the one of the second bar
+        rolling_std = self.rolling_.std() if len(self.rolling_.values_) > 1 else 0.
+        return [rolling_mean, rolling_std, rolling_mean + 2 * rolling_std, rolling_mean - 2 * rolling_std, value / rolling_mean]
+
+
+@register_feature("ema")
+class ExponentialMovingAverage(BaseFeature):
+    '''
+    The exponential moving average of a column over a span of bars
+    '''
+    def __init__(self, span=20, column="close"):
+        super().__init__(span=span, column=column)
+        self.column_ = column
+        self.alpha_ = 2 / (span + 1)
+        self.name_ = f"ema_{span}"
+        self.last_ = None
+
+    def names(self):
+        return [self.name_]
+
+    def compute(self, data):
+        values = ewm(data[self.column_].to_numpy(dtype=np.float64), self.alpha_)
+        self.last_ = values[-1] if len(values) else None
+        return {self.name_: values}
+
+    def update(self, bar):
+        value = float(bar[self.column_])
+        self.last_ = value if self.last_ is None else (1 - self.alpha_) * self.last_ + self.alpha_ * value
+        return [self.last_]
+
+
+@register_feature("macd")
+class MovingAverageConvergenceDivergence(BaseFeature):
+    '''
+    The difference of a fast and a slow exponential moving average, its signal line and
+    the histogram between both
+    '''
+    def __init__(self, fast=12, slow=26, signal=9, column="close"):
+        super().__init__(fast=fast, slow=slow, signal=signal, column=column)
+        self.fast_ = ExponentialMovingAverage(span=fast, column=column)
+        self.slow_ = ExponentialMovingAverage(span=slow, column=column)
+        self.signal_alpha_ = 2 / (signal + 1)
+        self.signal_ = None
+
+    def names(self):
+        return ["macd", "macd_signal", "macd_hist"]
+
+    def compute(self, data):
+        macd = self.fast_.compute(data)[self.fast_.name_] - self.slow_.compute(data)[self.slow_.name_]
+        signal = ewm(macd, self.signal_alpha_)
+        self.signal_ = signal[-1] if len(signal) else None
+        return {"macd": macd, "macd_signal": signal, "macd_hist": macd - signal}
+
+    def update(self, bar):
+        macd = self.fast_.update(bar)[0] - self.slow_.update(bar)[0]
+        self.signal_ = macd if self.signal_ is None else (1 - self.signal_alpha_) * self.signal_ + self.signal_alpha_ * macd
+        return [macd, self.signal_, macd - self.signal_]
+
+
+@register_feature("rsi")
+class RelativeStrengthIndex(BaseFeature):
+    '''
+    The relative strength index of a column, with Wilder's smoothing of the gains and
+    losses over 'window' bars. It is 50 while there was neither gain nor loss.
+    '''
+    def __init__(self, window=14, column="close"):
+        super().__init__(window=window, column=column)
+        self.column_ = column
+        self.alpha_ = 1 / window
+        self.name_ = f"rsi_{window}"
+        self.previous_, self.gain_, self.loss_ = None, None, None
+
+    def names(self):
+        return [self.name_]
+
+    def rsi(self, gain, loss):
+        '''
+        A method that returns the RSI from the average gain and loss
+        '''
+        total = gain + loss
+        return np.where(total > 0, 100 * gain / np.where(total > 0, total, 1.), 50.)
+
+    def compute(self, data):
+        values = data[self.column_].to_numpy(dtype=np.float64)
+        changes = np.diff(values, prepend=values[:1])
+        gain = ewm(np.maximum(changes, 0.), self.alpha_)
+        loss = ewm(np.maximum(-changes, 0.), self.alpha_)
+        if len(values):
+            self.previous_, self.gain_, self.loss_ = values[-1], gain[-1], loss[-1]
+        return {self.name_: self.rsi(gain, loss)}
+
+    def update(self, bar):
+        value = float(bar[self.column_])
+        change = 0. if self.previous_ is None else value - self.previous_
+        gain, loss = max(change, 0.), max(-change, 0.)
+        if self.gain_ is None:
+            self.gain_, self.loss_ = gain, loss
+        else:
+            self.gain_ = (1 - self.alpha_) * self.gain_ + self.alpha_ * gain
+            self.loss_ = (1 - self.alpha_) * self.loss_ + self.alpha_ * loss
+        self.previous_ = value
+        return [float(self.rsi(self.gain_, self.loss_))]
+
+
+@register_feature("atr")
+class AverageTrueRange(BaseFeature):
+    '''
+    The average true range over 'window' bars with Wilder's smoothing
+    '''
+    def __init__(self, window=14):
+        super().__init__(window=window)
+        self.alpha_ = 1 / window
+        self.name_ = f"atr_{window}"
+        self.previous_close_, self.last_ = None, None
+
+    def names(self):
+        return [self.name_]
+
+    def compute(self, data):
+        high, low, close = (data[column].to_numpy(dtype=np.float64) for column in ["high", "low", "close"])
+        previous_close = np.concatenate([close[:1], close[:-1]])
+        true_range = np.maximum(high - low, np.maximum(np.abs(high - previous_close), np.abs(low - previous_close)))
+        true_range[:1] = high[:1] - low[:1]
+        values = ewm(true_range, self.alpha_)
+        if len(values):
+            self.previous_close_, self.last_ = close[-1], values[-1]
+        return {self.name_: values}
+
+    def update(self, bar):
+        high, low, close = float(bar["high"]), float(bar["low"]), float(bar["close"])
+        true_range = high - low
+        if self.previous_close_ is not None:
+            true_range = max(true_range, abs(high - self.previous_close_), abs(low - self.previous_close_))
+        self.last_ = true_range if self.last_ is None else (1 - self.alpha_) * self.last_ + self.alpha_ * true_range
+        self.previous_close_ = close
+        return [self.last_]
+
+
+@register_feature("volume_zscore")
+class VolumeZScore(BaseFeature):
+    '''
+    The z-score of a volume column against its rolling mean and standard deviation over
+    'window' bars, 0 while the deviation is undefined
+    '''
+    def __init__(self, window=20, column="volume USDT"):
+        super().__init__(window=window, column=column)
+        self.window_ = window
+        self.column_ = column
+        self.name_ = f"volume_zscore_{window}"
+        self.rolling_ = RollingWindow(window)
+
+    def names(self):
+        return [self.name_]
+
+    def compute(self, data):
+        values = data[self.column_].astype(np.float64)
+        rolling = values.rolling(window=self.window_, min_periods=1)
+        zscore = ((values - rolling.mean()) / rolling.std()).replace([np.inf, -np.inf], np.nan).fillna(0.)
+        self.rolling_.fill(values.to_numpy())
+        return {self.name_: zscore.to_numpy()}
+
+    def update(self, bar):
+        value = float(bar[self.column_])
+        self.rolling_.push(value)
+        std = self.rolling_.std()
+        return [0. if math.isnan(std) or std == 0. else (value - self.rolling_.mean_) / std]
+
+
+class FeatureEngine:
+    '''
+    The engine computing a list of registered features, given as (name, params) specs.
+    compute() builds all the columns over a frame (cached), append() then updates them in
+    O(1) with every new bar.
+    '''
+    # The last batch results of this process, shared by every engine, least recently used
+    # first. With a 'cache_dir', the results are also saved there as .npy files.
+    memory_cache_ = OrderedDict()
+
+    def __init__(self, specs, cache_dir=None):
+        self.specs_ = [(name, dict(params)) for name, params in specs]
+        self.cache_dir_ = cache_dir
+        self.features_ = [FEATURES[name](**params) for name, params in self.specs_]
+        self.pending_data_ = None
+
+    def names(self):
+        '''
+        A method that returns the names of the columns of all the features
+        '''
+        return [name for feature in self.features_ for name in feature.names()]
+
+    def cache_key(self, data):
+        '''
+        A method that returns the key of the results for a frame: a hash of its dates,
+        of its values and of the feature specs
+        '''
+        digest = hashlib.sha1(json.dumps(self.specs_, sort_keys=True).encode())
+        digest.update(np.ascontiguousarray(data.index.to_numpy()).view(np.uint8) if data.index.dtype != object else str(list(data.index)).encode())
+        digest.update(json.dumps(list(data.columns)).encode())
+        digest.update(np.ascontiguousarray(data.to_numpy(dtype=np.float64)).view(np.uint8))
+        return digest.hexdigest()
+
+    def compute(self, data):
+        '''
+        A method that returns the columns of all the features over a frame as a data frame
+        with the same index, from the cache when possible. The features are then ready to
+        append the bars that follow the frame.
+        '''
+        key = self.cache_key(data)
+        path = os.path.join(self.cache_dir_, f"{key}.npy") if self.cache_dir_ else None
+        values = self.memory_cache_.get(key)
+        if values is None and path and os.path.exists(path):
+            values = np.load(path)
+        if values is None:
+            columns = {}
+            for feature in self.features_:
+                columns.update(feature.compute(data))
+            values = np.stack([np.asarray(columns[name], dtype=np.float64) for name in self.names()], axis=1) if len(data) else np.empty((0, len(self.names())))
+            if path:
+                os.makedirs(self.cache_dir_, exist_ok=True)
+                tmp_path = f"{path[:-4]}.tmp{os.getpid()}.npy"
+                np.save(tmp_path, values)
+                os.replace(tmp_path, path)
+            self.pending_data_ = None
+        else:
+            # The cached columns are reused, the state of the features is only built if
+            # bars are appended
+            self.pending_data_ = data
+        self.memory_cache_[key] = values
+        self.memory_cache_.move_to_end(key)
+        while len(self.memory_cache_) > MEMORY_CACHE_SIZE:
+            self.memory_cache_.popitem(last=False)
+        return pd.DataFrame(values, index=data.index, columns=self.names())
+
+    def warm_up(self):
+        '''
+        A method to build the state of the features at the end of the last computed frame
+        if its columns came from the cache
+        '''
+        if self.pending_data_ is not None:
+            for feature in self.features_:
+                feature.compute(self.pending_data_)
+            self.pending_data_ = None
+
+    def append(self, bar):
+        '''
+        A method that updates every feature with a new bar, a mapping of the data columns,
+        and returns their new values
+        '''
+        self.warm_up()
+        return np.array([value for feature in self.features_ for value in feature.update(bar)])
+
+
+if __name__ == "__main__":
+    from loader import TradingDataLoader
+
+    data = TradingDataLoader().data()
+    engine = FeatureEngine([("bollinger", {"window": 20}), ("ema", {"span": 12}), ("macd", {}), ("rsi", {}), ("atr", {}), ("volume_zscore", {})], cache_dir=None)
+    batch = engine.compute(data.iloc[:-100])
+    for date, bar in data.iloc[-100:].iterrows():
+        values = engine.append(bar)
+    print(dict(zip(engine.names(), values)))
+    print(engine.compute(data).iloc[-1].to_dict())
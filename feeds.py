@@ -0,0 +1,111 @@
+'''
+The file that contains the bar feeds of the streaming environment: the tail of a csv file
+being appended to, and a local socket server replaying a data frame as a stand-in for an
+exchange feed. Every feed is an iterator of bars, dictionaries of the csv columns.
+'''
+import csv
+import json
+import time
+import socket
+import threading
+import socketserver
+
+
+def parse_bar(bar):
+    '''
+    A function that converts the values of a bar to floats, except its date and symbol
+    '''
+    return {key: (value if key in ("date", "symbol") else float(value)) for key, value in bar.items()}
+
+
+class FileTailFeed:
+    '''
+    A feed that yields the bars of an oldest-first csv file, then the new lines appended to
+    it while 'follow' is set, checking for them every 'poll_interval' seconds
+    '''
+    def __init__(self, path, follow=True, poll_interval=.05, from_end=False):
+        self.path_ = path
+        self.follow_ = follow
+        self.poll_interval_ = poll_interval
+        self.from_end_ = from_end
+        self.stopped_ = False
+
+    def stop(self):
+        '''
+        A method to stop following the file
+        '''
+        self.stopped_ = True
+
+    def __iter__(self):
+        with open(self.path_, newline="") as f:
+            header = next(csv.reader([f.readline()]))
+            if self.from_end_:
+                f.seek(0, 2)
+            buffer = ""
+            while not self.stopped_:
+                line = f.readline()
+                if not line:
+                    if not self.follow_:
+                        break
+                    time.sleep(self.poll_interval_)
+                    continue
+                # A line is only complete once its end of line was written
+                buffer += line
+                if not buffer.endswith("\n"):
+                    continue
+                values, buffer = next(csv.reader([buffer])), ""
+                if values:
+                    yield parse_bar(dict(zip(header, values)))
+
+
+class ReplayServer:
+    '''
+    A local TCP server replaying the bars of a data frame indexed by date as JSON lines to
+    every client, 'speed' bars per second (as fast as possible if None)
+    '''
+    def __init__(self, data, host="127.0.0.1", port=0, speed=None):
+        records = data.reset_index()
+        records["date"] = records["date"].astype(str)
+        bars = records.to_dict("records")
+        delay = 1 / speed if speed else 0.
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for bar in bars:
+                    self.wfile.write((json.dumps(bar) + "\n").encode())
+                    if delay:
+                        time.sleep(delay)
+
+        self.server_ = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server_.daemon_threads = True
+        self.address_ = self.server_.server_address
+        self.thread_ = None
+
+    def start(self):
+        '''
+        A method to serve in a background thread. Returns the (host, port) address.
+        '''
+        self.thread_ = threading.Thread(target=self.server_.serve_forever, daemon=True)
+        self.thread_.start()
+        return self.address_
+
+    def stop(self):
+        '''
+        A method to stop serving
+        '''
+        self.server_.shutdown()
+        self.server_.server_close()
+
+
+class SocketFeed:
+    '''
+    A feed that yields the JSON line bars sent by a server, e.g. a ReplayServer
+    '''
+    def __init__(self, host="127.0.0.1", port=8765):
+        self.address_ = (host, port)
+
+    def __iter__(self):
+        with socket.create_connection(self.address_) as connection, connection.makefile("r") as lines:
+            for line in lines:
+                if line.strip():
+                    yield parse_bar(json.loads(line))
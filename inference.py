@@ -0,0 +1,53 @@
+'''
+The file that contains the torch-free inference runtime. A DenseModel saved with
+DenseModel.save_weights is loaded and evaluated with numpy only, so that a decision
+process does not have to import torch.
+'''
+import numpy as np
+
+# The layers of a DenseModel, in order, as named in its weights files
+LAYERS = ("l1_", "l2_", "l3_")
+
+
+class NumpyDenseModel:
+    '''
+    The numpy version of DenseModel.forward: linear layers with ReLUs in between, in float32.
+    Outputs are the ones of torch up to the summation order of the matrix products, which
+    torch itself changes with the batch size.
+    '''
+    def __init__(self, weights):
+        '''
+        Initialize object from a dictionary of arrays with the keys of a DenseModel state dict
+        '''
+        self.layers_ = [(np.asarray(weights[f"{layer}.weight"], dtype=np.float32).T.copy(),
+                         np.asarray(weights[f"{layer}.bias"], dtype=np.float32)) for layer in LAYERS]
+        self.input_dimension_ = self.layers_[0][0].shape[0]
+        self.output_dimension_ = self.layers_[-1][0].shape[1]
+
+    @classmethod
+    def load(cls, path):
+        '''
+        A method that loads the npz weights file written by DenseModel.save_weights
+        '''
+        with np.load(path) as weights:
+            return cls({key: weights[key] for key in weights.files})
+
+    def forward(self, X):
+        '''
+        Forward pass of a state, or of a (states, features) batch, in the model
+        '''
+        output = np.asarray(X, dtype=np.float32)
+        for i, (weight, bias) in enumerate(self.layers_):
+            if i:
+                output = np.maximum(output, 0.)
+            output = output @ weight + bias
+        return output
+
+    def __call__(self, X):
+        return self.forward(X)
+
+    def predict(self, state):
+        '''
+        A method that returns the greedy action of a state
+        '''
+        return int(self.forward(state).argmax())
@@ -0,0 +1,141 @@
+'''
+The file that contains the streaming ingestion of exchange csv files. The csv is read in
+chunks and appended to append-only column files (one raw binary file per column plus the
+dates) that TradingDataLoader(ingested=True) memory-maps. Exchange files are newest-first,
+the chunks are then reversed through small spill files instead of sorting the whole file.
+A refresh only reads the csv until it reaches bars that were already ingested.
+'''
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from loader import write_json
+
+DROPPED_COLUMNS = ["unix", "symbol"]
+
+
+def validate_bars(df):
+    '''
+    A function that drops the invalid bars of a chunk sorted by date: duplicated dates,
+    missing values, negative volumes or prices outside of the [low, high] range.
+    Returns the valid bars and the number of dropped ones.
+    '''
+    prices = df[["open", "high", "low", "close"]]
+    volumes = df.drop(columns=["open", "high", "low", "close"])
+    is_valid = ~df.index.duplicated(keep="first")
+    is_valid &= df.notna().all(axis=1).to_numpy()
+    is_valid &= (volumes >= 0).all(axis=1).to_numpy()
+    is_valid &= (prices["low"] <= prices[["open", "close", "high"]].min(axis=1)).to_numpy()
+    is_valid &= (prices["high"] >= prices[["open", "close", "low"]].max(axis=1)).to_numpy()
+    return df[is_valid], int((~is_valid).sum())
+
+def read_meta(out_dir):
+    '''
+    A function that reads the metadata of an ingested data set, None if there is none
+    '''
+    meta_path = os.path.join(out_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+def ingest_csv(path, out_dir, chunksize=100_000):
+    '''
+    A function that appends the bars of an exchange csv file newer than the last ingested
+    one to the column files of 'out_dir'. Memory use is bounded by the chunk size.
+    Returns a report with the number of read, appended and dropped bars.
+    '''
+    meta = read_meta(out_dir)
+    last_date = meta["last_date"] if meta else None
+    report = {"read": 0, "appended": 0, "dropped": 0}
+
+    spill_dir = os.path.join(out_dir, f"spill.tmp{os.getpid()}")
+    os.makedirs(spill_dir, exist_ok=True)
+    spills, columns, dtypes, is_descending, boundary = [], None, None, None, None
+    try:
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            chunk = chunk.drop(columns=[column for column in DROPPED_COLUMNS if column in chunk.columns])
+            dates = pd.to_datetime(chunk.pop("date")).to_numpy(dtype="datetime64[ns]").view(np.int64)
+            if columns is None:
+                columns = list(chunk.columns)
+                dtypes = [str(chunk[column].dtype) for column in columns] if meta is None else meta["dtypes"]
+                assert meta is None or meta["columns"] == columns, "The csv columns changed since the last ingestion"
+            report["read"] += len(chunk)
+            if is_descending is None and len(dates) > 1:
+                is_descending = bool(dates[0] > dates[-1])
+
+            # Only keep what was not ingested yet
+            is_new = dates > last_date if last_date is not None else np.ones(len(dates), dtype=bool)
+            chunk = chunk[is_new].set_index(pd.Index(dates[is_new], name="date")).sort_index(kind="stable")
+            chunk, num_dropped = validate_bars(chunk)
+            report["dropped"] += num_dropped
+
+            if len(chunk):
+                chunk_dates = chunk.index.to_numpy()
+                # Chunks must follow each other in the file order, the bar on the boundary
+                # between two chunks may be repeated
+                if boundary is not None:
+                    if is_descending:
+                        assert chunk_dates[-1] <= boundary, "The csv file is not sorted by date"
+                        chunk = chunk[chunk_dates < boundary]
+                    else:
+                        assert chunk_dates[0] >= boundary, "The csv file is not sorted by date"
+                        chunk = chunk[chunk_dates > boundary]
+                    chunk_dates = chunk.index.to_numpy()
+                if len(chunk):
+                    boundary = chunk_dates[0] if is_descending else chunk_dates[-1]
+                    spill = os.path.join(spill_dir, f"{len(spills)}.npz")
+                    np.savez(spill, date=chunk_dates, **{str(i): chunk[column].to_numpy(dtype=dtype) for i, (column, dtype) in enumerate(zip(columns, dtypes))})
+                    spills.append(spill)
+
+            # In a newest-first file, everything after an already ingested bar is older
+            if is_descending and not is_new.all():
+                break
+
+        if not spills:
+            return report
+        if meta is None:
+            meta = {"columns": columns, "dtypes": dtypes, "index_name": "date", "length": 0, "last_date": None}
+        append_spills(out_dir, meta, spills[::-1] if is_descending else spills, report)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    return report
+
+def append_spills(out_dir, meta, spills, report):
+    '''
+    A function that appends the spill files, oldest first, to the column files then
+    commits the new length in the metadata. Bytes past the committed length, left by an
+    interrupted ingestion, are truncated first.
+    '''
+    files = ["index.bin"] + [f"{i}.bin" for i in range(len(meta["columns"]))]
+    itemsizes = [8] + [np.dtype(dtype).itemsize for dtype in meta["dtypes"]]
+    handles = []
+    for filename, itemsize in zip(files, itemsizes):
+        handle = open(os.path.join(out_dir, filename), "ab")
+        handle.truncate(meta["length"] * itemsize)
+        handles.append(handle)
+
+    length, last_date = meta["length"], meta["last_date"]
+    try:
+        for spill in spills:
+            with np.load(spill) as values:
+                handles[0].write(values["date"].tobytes())
+                for i in range(len(meta["columns"])):
+                    handles[i + 1].write(values[str(i)].tobytes())
+                length += len(values["date"])
+                last_date = int(values["date"][-1])
+    finally:
+        for handle in handles:
+            handle.close()
+
+    report["appended"] = length - meta["length"]
+    meta.update(length=length, last_date=last_date)
+    write_json(os.path.join(out_dir, "meta.json"), meta)
+
+
+if __name__ == "__main__":
+    report = ingest_csv("./data/eth_usdt_hourly.csv", "./data/.ingested/eth_usdt_hourly", chunksize=1_000)
+    print(report)
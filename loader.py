@@ -1,34 +1,213 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import numpy as np
 import pandas as pd
 
+CACHE_VERSION = 2
+
 class TradingDataLoader():
     '''
-    A class to load our trading data in a pandas data frame
+    A class to load our trading data in a pandas data frame.
+    The first load of a csv file writes a columnar cache next to it (one .npy file per
+    column plus the dates), the next loads memory-map it instead of parsing the csv, so
+    that startup is fast and processes loading the same data share the pages.
+    With a 'store' (a datastore.TradingDataStore), the data is queried from its aligned
+    panels instead, 'time_step' being any of its base or resampled time steps.
+    With 'ingested', the data is memory-mapped from the column files that
+    ingest.ingest_csv appends to under <data_dir>/.ingested.
     '''
-    def __init__(self, crypto_pair="ETH/USDT", time_step="hourly", start_date="2021-01-01 00:00:00", end_date="2021-12-31 23:00:00"):
+    def __init__(self, crypto_pair="ETH/USDT", time_step="hourly", start_date="2021-01-01 00:00:00", end_date="2021-12-31 23:00:00",
+                 data_dir="./data", cache=True, cache_dir=None, store=None, ingested=False):
         self.crypto_pair_ = crypto_pair
         self.time_step_ = time_step
         self.start_date_ = start_date
         self.end_date_ = end_date
+        self.data_dir_ = data_dir
+        self.cache_ = cache
+        self.cache_dir_ = cache_dir if cache_dir is not None else os.path.join(data_dir, ".cache")
+        self.ingested_ = ingested
+
+        if store is not None:
+            self.data_ = store.frame(crypto_pair, start_date, end_date, time_step=time_step)
+            return
 
         filename = "_".join(crypto_pair.lower().split("/")) + "_" + time_step
         self.data_ = self.__load_data_set(filename, start_date, end_date)
-        
+
     def __load_data_set(self, filename, start_date, end_date):
         '''
         A private method to load a pandas data frame with our crypto data in it
         '''
-        path = f"./data/{filename}.csv"
-        df = pd.read_csv(path)
-        df.drop(labels=["unix", "symbol"], axis=1, inplace=True)
-        df.sort_values("date", inplace=True)
-        df.set_index("date", inplace=True)
+        path = os.path.join(self.data_dir_, f"{filename}.csv")
+        if self.ingested_:
+            df = read_ingested(os.path.join(self.data_dir_, ".ingested", filename))
+        elif self.cache_:
+            df = self.__load_cache(path, os.path.join(self.cache_dir_, filename))
+        else:
+            df = read_csv(path)
         return df.loc[start_date:end_date]
 
+    def __load_cache(self, path, cache_path):
+        '''
+        A private method to memory-map the columnar cache of a csv file, (re)building it
+        when the csv file changed. The cache is keyed by the modification time and size of
+        the csv file, its content hash is only computed when they differ.
+        '''
+        # The version read can be removed by newer commits of other processes before all
+        # its files are opened, the current one is then resolved again
+        for attempt in range(3):
+            try:
+                return self.__read_cache(path, cache_path)
+            except FileNotFoundError:
+                if attempt == 2 or not os.path.exists(path):
+                    raise
+
+    def __read_cache(self, path, cache_path):
+        '''
+        A private method to memory-map the current version of the cache of a csv file,
+        (re)building it if needed
+        '''
+        version_path = current_version(cache_path)
+        meta_path = os.path.join(version_path, "meta.json") if version_path else None
+        stat = os.stat(path)
+        meta = None
+        if meta_path and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get("version") != CACHE_VERSION or meta["size"] != stat.st_size:
+                meta = None
+            elif meta["mtime_ns"] != stat.st_mtime_ns:
+                if meta["sha1"] == file_hash(path):
+                    meta["mtime_ns"] = stat.st_mtime_ns
+                    write_json(meta_path, meta)
+                else:
+                    meta = None
+        if meta is None:
+            meta, version_path = write_cache(read_csv(path), cache_path, path)
+
+        index = pd.DatetimeIndex(np.load(os.path.join(version_path, "index.npy"), mmap_mode="r").view("datetime64[ns]"), name=meta["index_name"])
+        columns = {column: np.load(os.path.join(version_path, f"{i}.npy"), mmap_mode="r").view(np.ndarray) for i, column in enumerate(meta["columns"])}
+        return pd.DataFrame(columns, index=index, copy=False)
+
     def data(self):
         ''' A public method that returns the loaded data set
         '''
         return self.data_
 
+def read_csv(path):
+    '''
+    A function that parses an exchange csv file into a data frame sorted by date
+    '''
+    df = pd.read_csv(path)
+    df.drop(labels=["unix", "symbol"], axis=1, inplace=True)
+    df["date"] = pd.to_datetime(df["date"])
+    df.set_index("date", inplace=True)
+    df.sort_index(inplace=True, kind="stable")
+    return df
+
+def read_ingested(path):
+    '''
+    A function that memory-maps the append-only column files written by ingest.ingest_csv,
+    up to the length committed in their metadata
+    '''
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    length = meta["length"]
+    dates = np.memmap(os.path.join(path, "index.bin"), dtype=np.int64, mode="r", shape=(length,)) if length else np.array([], dtype=np.int64)
+    index = pd.DatetimeIndex(dates.view("datetime64[ns]"), name=meta["index_name"])
+    columns = {}
+    for i, (column, dtype) in enumerate(zip(meta["columns"], meta["dtypes"])):
+        values = np.memmap(os.path.join(path, f"{i}.bin"), dtype=dtype, mode="r", shape=(length,)) if length else np.array([], dtype=dtype)
+        columns[column] = values.view(np.ndarray)
+    return pd.DataFrame(columns, index=index, copy=False)
+
+def file_hash(path):
+    '''
+    A function that returns the sha1 of a file content
+    '''
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_json(path, values):
+    '''
+    A function that atomically writes a json file
+    '''
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(values, f)
+    os.replace(tmp_path, path)
+
+def current_version(path):
+    '''
+    A function that returns the current version directory of a versioned directory, the
+    one its current.json pointer file names, or None if there is none
+    '''
+    try:
+        with open(os.path.join(path, "current.json")) as f:
+            version_path = os.path.join(path, json.load(f)["name"])
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    return version_path if os.path.isdir(version_path) else None
+
+def new_version(path):
+    '''
+    A function that returns a fresh temporary directory to write a new version of a
+    versioned directory in, see commit_version
+    '''
+    tmp_path = os.path.join(path, f"tmp-{os.getpid()}-{time.time_ns()}")
+    os.makedirs(tmp_path)
+    return tmp_path
+
+def commit_version(path, tmp_path):
+    '''
+    A function that makes a fully written new_version directory the current version:
+    it is renamed, then the pointer file is atomically replaced, so readers resolve either
+    the old or the new version, never a partial one. Concurrent writers each commit a
+    complete version and the last one wins. The versions other than the new and the
+    previous ones, which readers may have just resolved, are removed. Returns the path of
+    the new version.
+    '''
+    name = "v-" + os.path.basename(tmp_path)[len("tmp-"):]
+    os.replace(tmp_path, os.path.join(path, name))
+    previous = current_version(path)
+    write_json(os.path.join(path, "current.json"), {"name": name})
+    keep = {name, os.path.basename(previous) if previous else None}
+    for entry in os.listdir(path):
+        if entry.startswith("v-") and entry not in keep:
+            shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+    return os.path.join(path, name)
+
+def write_cache(df, cache_path, source_path):
+    '''
+    A function that writes a data frame indexed by date as one .npy file per column in a
+    new version of the cache directory, see commit_version, so readers never see a partial
+    cache. Returns the cache metadata and the path of the version.
+    '''
+    stat = os.stat(source_path)
+    meta = {
+        "version": CACHE_VERSION,
+        "source": os.path.abspath(source_path),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha1": file_hash(source_path),
+        "index_name": df.index.name,
+        "columns": list(df.columns),
+        "length": len(df),
+    }
+    tmp_path = new_version(cache_path)
+    np.save(os.path.join(tmp_path, "index.npy"), df.index.to_numpy(dtype="datetime64[ns]").view(np.int64))
+    for i, column in enumerate(df.columns):
+        np.save(os.path.join(tmp_path, f"{i}.npy"), df[column].to_numpy())
+    write_json(os.path.join(tmp_path, "meta.json"), meta)
+    return meta, commit_version(cache_path, tmp_path)
+
 if __name__ == "__main__":
     dataloader = TradingDataLoader()
     data = dataloader.data()
@@ -0,0 +1,421 @@
+'''
+The file that contains the replay memories used to train the agents
+'''
+import os
+import json
+from collections import deque
+
+import numpy as np
+
+EVICTIONS = ["random", "fifo"]
+
+
+class ReplayBuffer:
+    '''
+    A replay memory backed by preallocated numpy arrays. Inserting a transition is O(1)
+    and sampling only copies the sampled rows, so batches come out contiguous and can
+    be handed to torch.from_numpy directly.
+
+    One transition takes 2 * state_dimension * itemsize (state and new state) + 8 (int64
+    action) + 4 (float32 reward) + 1 (bool done) bytes, i.e. 149 bytes for the 17 float32
+    features of TradingBotEnv + Portfolio. See bytes_per_transition_.
+    '''
+    def __init__(self, capacity, state_dimension, eviction="random", random_gen=None, seed=None, dtype=np.float32):
+        assert eviction in EVICTIONS, f"Eviction should be one of: {EVICTIONS}"
+        self.capacity_ = capacity
+        self.state_dimension_ = state_dimension
+        self.eviction_ = eviction
+        self.random_gen_ = random_gen if random_gen is not None else np.random.default_rng(seed=seed)
+
+        self.states_ = np.zeros((capacity, state_dimension), dtype=dtype)
+        self.actions_ = np.zeros(capacity, dtype=np.int64)
+        self.new_states_ = np.zeros((capacity, state_dimension), dtype=dtype)
+        self.rewards_ = np.zeros(capacity, dtype=np.float32)
+        self.dones_ = np.zeros(capacity, dtype=bool)
+
+        self.bytes_per_transition_ = sum(values.itemsize * (state_dimension if values.ndim == 2 else 1)
+                                         for values in [self.states_, self.actions_, self.new_states_, self.rewards_, self.dones_])
+        self.size_ = 0
+        self.position_ = 0
+
+    def __len__(self):
+        return self.size_
+
+    def add(self, state, action, new_state, reward, is_done):
+        '''
+        A method to store a transition. Once the memory is full, the transition replaces
+        either the oldest one (fifo) or a random one (random). Returns the index it is
+        stored at.
+        '''
+        if self.size_ < self.capacity_:
+            index = self.size_
+            self.size_ += 1
+        elif self.eviction_ == "fifo":
+            index = self.position_
+            self.position_ = (self.position_ + 1) % self.capacity_
+        else:
+            index = self.random_gen_.integers(self.capacity_)
+
+        self.states_[index] = state
+        self.actions_[index] = action
+        self.new_states_[index] = new_state
+        self.rewards_[index] = reward
+        self.dones_[index] = is_done
+        return index
+
+    def add_batch(self, states, actions, new_states, rewards, dones):
+        '''
+        A method to store many transitions at once, with the same eviction rule as add.
+        Returns the indices they are stored at.
+        '''
+        num_transitions = len(actions)
+        free = min(self.capacity_ - self.size_, num_transitions)
+        indices = np.arange(self.size_, self.size_ + free)
+        self.size_ += free
+        num_evicted = num_transitions - free
+        if num_evicted:
+            if self.eviction_ == "fifo":
+                evicted = (self.position_ + np.arange(num_evicted)) % self.capacity_
+                self.position_ = (self.position_ + num_evicted) % self.capacity_
+            else:
+                evicted = self.random_gen_.integers(self.capacity_, size=num_evicted)
+            indices = np.concatenate([indices, evicted])
+
+        self.states_[indices] = states
+        self.actions_[indices] = actions
+        self.new_states_[indices] = new_states
+        self.rewards_[indices] = rewards
+        self.dones_[indices] = dones
+        return indices
+
+    def sample(self, batch_size):
+        '''
+        A method to sample a batch of transitions uniformly with replacement. If fewer than
+        batch_size transitions are stored, all of them are returned.
+        Returns the (states, actions, new_states, rewards, dones) arrays.
+        '''
+        if self.size_ < batch_size:
+            indices = np.arange(self.size_)
+        else:
+            indices = self.random_gen_.integers(self.size_, size=batch_size)
+        return self.get(indices)
+
+    def get(self, indices):
+        '''
+        A method to gather the transitions at the given indices
+        '''
+        return self.states_[indices], self.actions_[indices], self.new_states_[indices], self.rewards_[indices], self.dones_[indices]
+
+    def clear(self):
+        '''
+        A method to empty the memory, the arrays are kept allocated
+        '''
+        self.size_ = 0
+        self.position_ = 0
+
+    def save(self, path):
+        '''
+        A method to write the filled part of the memory in a directory, one .npy file per
+        array so that they can be memory-mapped back, plus the counters and the state of
+        the random generator in a json file
+        '''
+        os.makedirs(path, exist_ok=True)
+        for name, values in self.arrays().items():
+            np.save(os.path.join(path, f"{name}.npy"), values)
+        with open(os.path.join(path, "memory.json"), "w") as f:
+            json.dump(self.get_config(), f)
+
+    def load(self, path):
+        '''
+        A method to restore a memory written by save in place, the capacity and state
+        dimension must match
+        '''
+        with open(os.path.join(path, "memory.json")) as f:
+            config = self.load_config(json.load(f))
+        for name, values in self.arrays().items():
+            values[...] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        return config
+
+    def load_config(self, config):
+        '''
+        A method to restore the state returned by get_config in place, e.g. only the state
+        of the random generator of a memory that is cleared anyway. Returns the config.
+        '''
+        assert (config["capacity"], config["state_dimension"]) == (self.capacity_, self.state_dimension_), "The saved memory has another shape"
+        self.size_, self.position_ = config["size"], config["position"]
+        self.random_gen_.bit_generator.state = config["random_gen"]
+        return config
+
+    def arrays(self):
+        '''
+        A method that returns views on the filled part of the arrays to save, by name
+        '''
+        return {name: getattr(self, f"{name}_")[:self.size_] for name in ["states", "actions", "new_states", "rewards", "dones"]}
+
+    def get_config(self):
+        '''
+        A method that returns the json serializable state of the memory, arrays excluded
+        '''
+        return {"capacity": self.capacity_, "state_dimension": self.state_dimension_, "eviction": self.eviction_,
+                "size": self.size_, "position": self.position_, "random_gen": self.random_gen_.bit_generator.state}
+
+
+class IndexedReplayBuffer(ReplayBuffer):
+    '''
+    A replay memory for environments with lookback windows (see TradingBotEnv with an
+    observation_window): the market part of a state is stored as its index in the
+    (time, k, features) windows of the environment, that all the transitions share, and
+    only the small portfolio part is copied. Full states are rebuilt at sample time.
+    A transition takes 16 bytes of indices on top of the ReplayBuffer transition of the
+    portfolio states, whatever the window size.
+
+    States are given to add as (market index, portfolio state) pairs, to add_batch as a
+    pair of (market indices, portfolio states) arrays.
+    '''
+    def __init__(self, capacity, windows, portfolio_dimension, eviction="random", random_gen=None, seed=None, dtype=np.float32):
+        super().__init__(capacity, portfolio_dimension, eviction=eviction, random_gen=random_gen, seed=seed, dtype=dtype)
+        self.windows_ = windows
+        self.market_dimension_ = int(np.prod(windows.shape[1:]))
+        self.market_indices_ = np.zeros(capacity, dtype=np.int64)
+        self.new_market_indices_ = np.zeros(capacity, dtype=np.int64)
+        self.bytes_per_transition_ += 2 * self.market_indices_.itemsize
+
+    def add(self, state, action, new_state, reward, is_done):
+        '''
+        A method to store a transition, see ReplayBuffer.add
+        '''
+        index = super().add(state[1], action, new_state[1], reward, is_done)
+        self.market_indices_[index] = state[0]
+        self.new_market_indices_[index] = new_state[0]
+        return index
+
+    def add_batch(self, states, actions, new_states, rewards, dones):
+        '''
+        A method to store many transitions at once, see ReplayBuffer.add_batch
+        '''
+        indices = super().add_batch(states[1], actions, new_states[1], rewards, dones)
+        self.market_indices_[indices] = states[0]
+        self.new_market_indices_[indices] = new_states[0]
+        return indices
+
+    def get(self, indices):
+        '''
+        A method to gather the transitions at the given indices, with their full states
+        '''
+        states, actions, new_states, rewards, dones = super().get(indices)
+        states = self.stack(self.market_indices_[indices], states)
+        new_states = self.stack(self.new_market_indices_[indices], new_states)
+        return states, actions, new_states, rewards, dones
+
+    def stack(self, market_indices, portfolio_states):
+        '''
+        A method that builds full states from market indices and portfolio states
+        '''
+        states = np.empty((len(market_indices), self.market_dimension_ + self.state_dimension_), dtype=self.states_.dtype)
+        states[:, :self.market_dimension_] = self.windows_[market_indices].reshape(len(market_indices), self.market_dimension_)
+        states[:, self.market_dimension_:] = portfolio_states
+        return states
+
+    def arrays(self):
+        '''
+        A method that returns views on the filled part of the arrays to save by name, the
+        market indices included. The windows belong to the environment and are not saved.
+        '''
+        return {**super().arrays(), "market_indices": self.market_indices_[:self.size_], "new_market_indices": self.new_market_indices_[:self.size_]}
+
+
+class NStepTransitions:
+    '''
+    A writer turning the 1-step transitions of an episode into n-step ones before adding
+    them to a memory: the reward of a transition becomes the discounted sum of the n
+    rewards that follow it and its new state the state n steps later. At the end of an
+    episode, the transitions left are added with their shorter sums and flagged done, so
+    that DQNAgent.train uses those sums alone as targets. The others are bootstrapped with
+    discount ** n.
+    '''
+    def __init__(self, memory, n_steps, discount):
+        self.memory_ = memory
+        self.n_steps_ = n_steps
+        self.discounts_ = discount ** np.arange(n_steps)
+        self.pending_ = deque()
+
+    def add(self, state, action, new_state, reward, is_done):
+        '''
+        A method to add a 1-step transition, the n-step transitions it completes are
+        added to the memory
+        '''
+        self.pending_.append((state, action, reward))
+        if is_done:
+            while self.pending_:
+                self.__add_first(new_state, True)
+        elif len(self.pending_) == self.n_steps_:
+            self.__add_first(new_state, False)
+
+    def clear(self):
+        '''
+        A method to drop the transitions of an unfinished episode
+        '''
+        self.pending_.clear()
+
+    def __add_first(self, new_state, is_done):
+        '''
+        A private method to add the oldest pending transition to the memory
+        '''
+        rewards = [reward for _, _, reward in self.pending_]
+        state, action, _ = self.pending_.popleft()
+        self.memory_.add(state, action, new_state, float(np.dot(self.discounts_[:len(rewards)], rewards)), is_done)
+
+
+class SumTree:
+    '''
+    A binary tree stored in a flat numpy array where every node holds the sum of its
+    children. Leaves hold the priorities, so that updating priorities and sampling
+    proportionally to them is O(log n), and both are vectorized over a whole batch.
+    '''
+    def __init__(self, capacity):
+        self.capacity_ = capacity
+        # Round the number of leaves up to a power of two so all leaves are at the same depth
+        self.depth_ = max(int(np.ceil(np.log2(capacity))), 0)
+        self.num_leaves_ = 2 ** self.depth_
+        # Node 1 is the root, the children of node i are 2i and 2i + 1, leaves start at num_leaves_
+        self.tree_ = np.zeros(2 * self.num_leaves_)
+
+    def total(self):
+        '''
+        A method to get the sum of all priorities
+        '''
+        return self.tree_[1]
+
+    def get(self, indices):
+        '''
+        A method to get the priorities at the given indices
+        '''
+        return self.tree_[np.asarray(indices) + self.num_leaves_]
+
+    def update(self, indices, priorities):
+        '''
+        A method to set the priorities at the given indices and propagate the new sums
+        up to the root, one tree level at a time
+        '''
+        nodes = np.asarray(indices) + self.num_leaves_
+        self.tree_[nodes] = priorities
+        for _ in range(self.depth_):
+            nodes = np.unique(nodes // 2)
+            self.tree_[nodes] = self.tree_[2 * nodes] + self.tree_[2 * nodes + 1]
+
+    def set(self, index, priority):
+        '''
+        A method to set a single priority, cheaper than update on the per-step path
+        '''
+        node = index + self.num_leaves_
+        tree = self.tree_
+        tree[node] = priority
+        for _ in range(self.depth_):
+            node //= 2
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+
+    def find(self, values):
+        '''
+        A method to get the indices of the leaves whose cumulative priority range
+        contains each of the given values
+        '''
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth_):
+            left = 2 * nodes
+            go_right = values > self.tree_[left]
+            values -= np.where(go_right, self.tree_[left], 0.)
+            nodes = left + go_right
+        return np.minimum(nodes - self.num_leaves_, self.capacity_ - 1)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    '''
+    A replay memory that samples transitions proportionally to priority ** alpha, the
+    priority being the last absolute TD error of the transition. New transitions get the
+    maximum priority seen so far so that they are sampled at least once.
+    The importance-sampling weights are normalized by their maximum over the batch.
+    '''
+    def __init__(self, capacity, state_dimension, alpha=.6, beta=.4, beta_increment=0., epsilon=1e-6,
+                 eviction="random", random_gen=None, seed=None, dtype=np.float32):
+        super().__init__(capacity, state_dimension, eviction=eviction, random_gen=random_gen, seed=seed, dtype=dtype)
+        self.alpha_ = alpha
+        self.beta_ = beta
+        self.beta_increment_ = beta_increment
+        self.epsilon_ = epsilon
+        self.max_priority_ = 1.
+        self.tree_ = SumTree(capacity)
+        self.bytes_per_transition_ += self.tree_.tree_.itemsize * 2
+
+    def add(self, state, action, new_state, reward, is_done):
+        '''
+        A method to store a transition with the maximum priority
+        '''
+        index = super().add(state, action, new_state, reward, is_done)
+        self.tree_.set(index, self.max_priority_ ** self.alpha_)
+        return index
+
+    def add_batch(self, states, actions, new_states, rewards, dones):
+        '''
+        A method to store many transitions at once with the maximum priority
+        '''
+        indices = super().add_batch(states, actions, new_states, rewards, dones)
+        self.tree_.update(indices, np.full(len(indices), self.max_priority_ ** self.alpha_))
+        return indices
+
+    def sample(self, batch_size):
+        '''
+        A method to sample a batch of transitions proportionally to their priorities, with
+        one draw in each of batch_size equal segments of the total priority.
+        Returns the batch, the sampled indices and their importance-sampling weights.
+        As with uniform sampling, the batch is smaller while fewer transitions are stored.
+        '''
+        batch_size = min(batch_size, self.size_)
+        total = self.tree_.total()
+        values = (np.arange(batch_size) + self.random_gen_.random(size=batch_size)) * total / batch_size
+        # Never return a slot that is not filled yet because of rounding errors in the tree
+        indices = np.minimum(self.tree_.find(values), self.size_ - 1)
+
+        probabilities = self.tree_.get(indices) / total
+        weights = (self.size_ * probabilities) ** -self.beta_
+        weights = (weights / weights.max()).astype(np.float32)
+        self.beta_ = min(1., self.beta_ + self.beta_increment_)
+
+        return self.get(indices), indices, weights
+
+    def update_priorities(self, indices, td_errors):
+        '''
+        A method to update the priorities of the sampled transitions from their TD errors
+        '''
+        priorities = np.abs(td_errors) + self.epsilon_
+        self.max_priority_ = max(self.max_priority_, priorities.max())
+        self.tree_.update(indices, priorities ** self.alpha_)
+
+    def clear(self):
+        '''
+        A method to empty the memory and its priorities
+        '''
+        super().clear()
+        self.tree_.tree_[:] = 0.
+        self.max_priority_ = 1.
+
+    def load_config(self, config):
+        '''
+        A method to restore the state returned by get_config in place, the sampling
+        parameters included. The priorities are restored by load.
+        '''
+        config = super().load_config(config)
+        self.alpha_, self.beta_, self.max_priority_ = config["alpha"], config["beta"], config["max_priority"]
+        return config
+
+    def arrays(self):
+        '''
+        A method that returns views on the arrays to save by name, the sum tree included
+        '''
+        return {**super().arrays(), "tree": self.tree_.tree_}
+
+    def get_config(self):
+        '''
+        A method that returns the json serializable state of the memory, arrays excluded
+        '''
+        return {**super().get_config(), "alpha": self.alpha_, "beta": self.beta_, "max_priority": float(self.max_priority_)}
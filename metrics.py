@@ -0,0 +1,294 @@
+'''
+The file that contains the metrics sink of the runners. Metrics are registered once by
+name and get a slot: updating a counter, a gauge or a histogram is then a write to a list,
+with no string formatting on the hot path. tick(), called once per step, reads the clock
+and, at most every 'flush_interval' seconds, hands a snapshot of the metrics to a
+background thread writing them to a JSONL or CSV file, and at most every
+'console_interval' seconds prints a progress line. The metrics can also be served as a
+Prometheus text endpoint.
+'''
+import csv
+import json
+import time
+import queue
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Default histogram buckets, of decision latencies in seconds and of training losses
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, .1)
+LOSS_BUCKETS = (1e-4, 1e-3, 1e-2, .1, 1., 10., 100., 1e3, 1e4)
+
+
+class MetricsSink:
+    '''
+    A sink of counters (sums), gauges (last values) and histograms (counts per bucket).
+    Snapshots are written by a background thread to 'path', as JSONL, or as CSV if it ends
+    with .csv (the columns being the metrics registered before the first snapshot).
+    'console' is a format string of the metric names, e.g. "{episode:.0f} - {loss: .4f}",
+    printed on one line at most every 'console_interval' seconds. With a
+    'prometheus_port', the metrics are served at http://127.0.0.1:<port>/metrics.
+    'labels' are constant fields added to every snapshot, e.g. a worker id.
+    '''
+    def __init__(self, path=None, flush_interval=1., console=None, console_interval=1., prometheus_port=None, labels=None):
+        self.path_ = path
+        self.flush_interval_ = flush_interval
+        self.console_ = console
+        self.console_interval_ = console_interval
+        self.labels_ = dict(labels or {})
+        self.kinds_ = {}
+        self.counter_names_, self.counters_ = [], []
+        self.gauge_names_, self.gauges_ = [], []
+        self.histogram_names_, self.buckets_, self.histograms_, self.histogram_sums_ = [], [], [], []
+
+        now = time.monotonic()
+        self.next_flush_ = now + flush_interval if path else float("inf")
+        self.next_console_ = now + console_interval if console else float("inf")
+        self.next_tick_ = min(self.next_flush_, self.next_console_)
+        self.console_dirty_ = False
+
+        self.queue_ = queue.Queue()
+        self.writer_ = None
+        if path:
+            self.writer_ = threading.Thread(target=self.__write, daemon=True)
+            self.writer_.start()
+
+        self.server_ = None
+        if prometheus_port is not None:
+            self.server_ = ThreadingHTTPServer(("127.0.0.1", prometheus_port), self.__get_handler())
+            self.server_.daemon_threads = True
+            threading.Thread(target=self.server_.serve_forever, daemon=True).start()
+        self.address_ = self.server_.server_address if self.server_ is not None else None
+
+    def counter(self, name):
+        '''
+        A method that registers a counter, or returns the slot of the existing one
+        '''
+        return self.__register(name, "counter", self.counter_names_, self.counters_)
+
+    def gauge(self, name):
+        '''
+        A method that registers a gauge, or returns the slot of the existing one
+        '''
+        return self.__register(name, "gauge", self.gauge_names_, self.gauges_)
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        '''
+        A method that registers a histogram with the upper bounds of its buckets, or
+        returns the slot of the existing one. Values above the last bound are counted in
+        an extra bucket.
+        '''
+        slot = self.__register(name, "histogram", self.histogram_names_, self.histograms_, [0] * (len(buckets) + 1))
+        if slot == len(self.buckets_):
+            self.buckets_.append(tuple(buckets))
+            self.histogram_sums_.append(0.)
+        return slot
+
+    def inc(self, slot, value=1):
+        '''
+        A method to add to a counter
+        '''
+        self.counters_[slot] += value
+
+    def set(self, slot, value):
+        '''
+        A method to set a gauge
+        '''
+        self.gauges_[slot] = value
+
+    def observe(self, slot, value):
+        '''
+        A method to add a value to a histogram
+        '''
+        self.histograms_[slot][bisect.bisect_left(self.buckets_[slot], value)] += 1
+        self.histogram_sums_[slot] += value
+
+    def tick(self):
+        '''
+        A method to call once per step: flushes and prints the progress line when due
+        '''
+        now = time.monotonic()
+        if now < self.next_tick_:
+            return
+        if now >= self.next_flush_:
+            self.flush()
+            self.next_flush_ = now + self.flush_interval_
+        if now >= self.next_console_:
+            self.print_progress()
+            self.next_console_ = now + self.console_interval_
+        self.next_tick_ = min(self.next_flush_, self.next_console_)
+
+    def values(self):
+        '''
+        A method that returns the current value of every counter and gauge by name
+        '''
+        return {**dict(zip(self.counter_names_, self.counters_)), **dict(zip(self.gauge_names_, self.gauges_))}
+
+    def snapshot(self):
+        '''
+        A method that returns the labels, the time and a copy of every metric, histograms
+        as dictionaries of their buckets, counts, sum and count
+        '''
+        histograms = {
+            name: {"buckets": list(buckets), "counts": list(counts), "sum": total, "count": sum(counts)}
+            for name, buckets, counts, total in zip(self.histogram_names_, self.buckets_, self.histograms_, self.histogram_sums_)
+        }
+        return {**self.labels_, "time": time.time(), **self.values(), **histograms}
+
+    def flush(self):
+        '''
+        A method to hand a snapshot to the writer thread, without waiting for the write
+        '''
+        if self.writer_ is not None:
+            self.queue_.put(self.snapshot())
+
+    def print_progress(self, end="\r"):
+        '''
+        A method to print the progress line now
+        '''
+        if self.console_:
+            print(self.console_.format_map(self.values()), end=end, flush=True)
+            self.console_dirty_ = end == "\r"
+
+    def end_progress(self):
+        '''
+        A method to print the last progress line and go to the next line, e.g. at the end
+        of an episode
+        '''
+        if not self.console_:
+            return
+        self.print_progress(end="\n")
+        self.next_console_ = time.monotonic() + self.console_interval_
+        self.next_tick_ = min(self.next_flush_, self.next_console_)
+
+    def close(self):
+        '''
+        A method to write a last snapshot, wait for the writer thread and stop serving
+        '''
+        if self.writer_ is not None:
+            self.flush()
+            self.queue_.put(None)
+            self.writer_.join()
+            self.writer_ = None
+        if self.server_ is not None:
+            self.server_.shutdown()
+            self.server_.server_close()
+            self.server_ = None
+        if self.console_dirty_:
+            print()
+            self.console_dirty_ = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def to_prometheus(self):
+        '''
+        A method that returns the metrics in the Prometheus text exposition format
+        '''
+        labels = ",".join(f'{key}="{value}"' for key, value in self.labels_.items())
+        separator, labels_block = ("," if labels else ""), (f"{{{labels}}}" if labels else "")
+        lines = []
+        for kind, names, values in (("counter", self.counter_names_, self.counters_), ("gauge", self.gauge_names_, self.gauges_)):
+            for name, value in zip(names, list(values)):
+                lines += [f"# TYPE {name} {kind}", f"{name}{labels_block} {float(value)!r}"]
+        for name, buckets, counts, total in zip(self.histogram_names_, self.buckets_, self.histograms_, self.histogram_sums_):
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], list(counts)):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+            lines += [f"{name}_sum{labels_block} {float(total)!r}", f"{name}_count{labels_block} {cumulative}"]
+        return "\n".join(lines) + "\n"
+
+    def __register(self, name, kind, names, values, initial=0.):
+        '''
+        A private method that adds a metric to the lists of its kind. Returns its slot.
+        '''
+        assert self.kinds_.setdefault(name, kind) == kind, f"{name} is already registered as a {self.kinds_[name]}"
+        if name in names:
+            return names.index(name)
+        names.append(name)
+        values.append(initial)
+        return len(values) - 1
+
+    def __write(self):
+        '''
+        A private method, the loop of the writer thread, that appends the snapshots of
+        the queue to the file until it gets None
+        '''
+        is_csv = self.path_.endswith(".csv")
+        with open(self.path_, "a", newline="") as f:
+            writer = None
+            while True:
+                snapshot = self.queue_.get()
+                if snapshot is None:
+                    return
+                if not is_csv:
+                    f.write(json.dumps(snapshot) + "\n")
+                else:
+                    # Histograms are flattened to their count and sum
+                    row = {}
+                    for name, value in snapshot.items():
+                        if isinstance(value, dict):
+                            row[f"{name}_count"], row[f"{name}_sum"] = value["count"], value["sum"]
+                        else:
+                            row[name] = value
+                    if writer is None:
+                        writer = csv.DictWriter(f, fieldnames=list(row), extrasaction="ignore")
+                        if not f.tell():
+                            writer.writeheader()
+                    writer.writerow(row)
+                # Written as soon as possible, the file is read while training runs
+                if self.queue_.empty():
+                    f.flush()
+
+    def __get_handler(self):
+        '''
+        A private method that returns the request handler of the Prometheus endpoint
+        '''
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class NullMetrics(MetricsSink):
+    '''
+    A sink that records nothing, e.g. for the workers of a sweep
+    '''
+    def __init__(self):
+        super().__init__()
+
+    def inc(self, slot, value=1):
+        return None
+
+    def set(self, slot, value):
+        return None
+
+    def observe(self, slot, value):
+        return None
+
+    def tick(self):
+        return None
+
+    def print_progress(self, end="\r"):
+        return None
+
+NULL_METRICS = NullMetrics()
@@ -1,3 +1,5 @@
+import numpy as np
+import torch
 import torch.nn as nn
 
 class DenseModel(nn.Module):
@@ -26,4 +28,41 @@ class DenseModel(nn.Module):
         output = nn.functional.relu(self.l1_(X))
         output = nn.functional.relu(self.l2_(output))
         return self.l3_(output)
-        
\ No newline at end of file
+        
+
+    def save_weights(self, path):
+        '''
+        A method to save the weights as a plain npz file, that NumpyDenseModel loads
+        without torch. Keys are the ones of the state dict, e.g. 'l1_.weight'.
+        '''
+        np.savez(path, **{key: value.detach().cpu().numpy() for key, value in self.state_dict().items()})
+
+    @classmethod
+    def from_weights(cls, path):
+        '''
+        A method that builds a DenseModel from an npz weights file
+        '''
+        with np.load(path) as weights:
+            model = cls(weights["l1_.weight"].shape[1], weights["l3_.weight"].shape[0])
+            model.load_state_dict({key: torch.from_numpy(weights[key]) for key in weights.files})
+        return model
+
+    def export_torchscript(self, path):
+        '''
+        A method to save the model as TorchScript, loadable with torch.jit.load without
+        this file
+        '''
+        torch.jit.script(self).save(path)
+
+
+if __name__ == "__main__":
+    import glob
+    import pickle as pk
+
+    # Convert the pickled models to weights files and TorchScript
+    for path in glob.glob("./models/*.pkl"):
+        with open(path, "rb") as f:
+            model = pk.Unpickler(f).load()
+        model.save_weights(path[:-len(".pkl")] + ".npz")
+        model.export_torchscript(path[:-len(".pkl")] + ".pt")
+        print(f"Exported {path}")
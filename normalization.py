@@ -0,0 +1,202 @@
+'''
+The file that contains the online normalization of the states fed to the agents. Raw
+features span many orders of magnitude (volumes around 1e7 next to ratios around 1 and
+portfolio flags), the normalizer z-scores every feature with running statistics, after
+log-scaling the volume like columns.
+'''
+import numpy as np
+
+# The raw metrics that are log-scaled by default: non-negative, spanning orders of
+# magnitude. Derived features such as volume_zscore_<w> can be negative and are not.
+LOG_METRICS = ("volume ETH", "volume USDT", "tradecount")
+
+
+class RunningNormalizer:
+    '''
+    A normalizer keeping the running mean and variance of every feature, updated with
+    Welford's algorithm one state at a time or with Chan's parallel formula for a batch.
+    Calling it updates the statistics then normalizes, unless it is frozen, e.g. for
+    evaluation. Columns in 'log_columns' go through log1p first, their statistics are the
+    ones of the log values. Normalized values are clipped to [-clip, clip] if given.
+    With 'update_every' n > 1, the states seen by calls are added to the statistics n at a
+    time, once the first n were added one by one, which divides the per-state cost by ~4.
+    '''
+    def __init__(self, dimension, log_columns=(), epsilon=1e-8, clip=None, update_every=1):
+        self.dimension_ = dimension
+        self.is_log_ = np.zeros(dimension, dtype=bool)
+        self.is_log_[list(log_columns)] = True
+        self.log_columns_ = np.flatnonzero(self.is_log_)
+        self.epsilon_ = epsilon
+        self.clip_ = clip
+        self.frozen_ = False
+        self.count_ = 0
+        self.mean_ = np.zeros(dimension)
+        self.m2_ = np.zeros(dimension)
+        # The standard deviations, kept up to date, and the buffers of the per-state path
+        self.std_ = np.ones(dimension)
+        self.value_ = np.empty(dimension)
+        self.delta_ = np.empty(dimension)
+        self.update_every_ = update_every
+        self.pending_ = np.empty((update_every, dimension))
+        self.num_pending_ = 0
+
+    @classmethod
+    def from_metrics(cls, metrics, log_metrics=LOG_METRICS, **kwargs):
+        '''
+        A method that builds a normalizer for states made of the given metrics, in order,
+        log-scaling the ones named in 'log_metrics'. With lookback windows, the metrics
+        are repeated once per row of the window.
+        '''
+        log_columns = [i for i, metric in enumerate(metrics) if metric in log_metrics]
+        return cls(len(metrics), log_columns=log_columns, **kwargs)
+
+    def freeze(self, frozen=True):
+        '''
+        A method to stop (or resume) updating the statistics, the pending states are added
+        '''
+        self.flush()
+        self.frozen_ = frozen
+        return self
+
+    def flush(self):
+        '''
+        A method to add the pending states to the statistics
+        '''
+        if self.num_pending_:
+            self.__update_batch(self.pending_[:self.num_pending_])
+            self.num_pending_ = 0
+
+    def update(self, values):
+        '''
+        A method to add a state, or a (states, features) batch, to the statistics
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            self.__update_one(self.__log_scale_one(values))
+            return
+        self.__update_batch(self.__log_scale(values, self.is_log_))
+
+    def __update_batch(self, values):
+        '''
+        A private method to add log-scaled states to the statistics with Chan's formula
+        '''
+        num_values = len(values)
+        if not num_values:
+            return
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+        total = self.count_ + num_values
+        delta = batch_mean - self.mean_
+        self.mean_ += delta * num_values / total
+        self.m2_ += batch_m2 + delta ** 2 * self.count_ * num_values / total
+        self.count_ = total
+        self.__update_std()
+
+    def get_std(self):
+        '''
+        A method that returns the running standard deviations, 1 for constant features
+        '''
+        return self.std_.copy()
+
+    def transform(self, values, columns=slice(None)):
+        '''
+        A method that normalizes a state or a (states, features) batch without updating the
+        statistics. 'columns' selects the features the values are, e.g. the market part of
+        the states.
+        '''
+        values = self.__log_scale(np.asarray(values, dtype=np.float64), self.is_log_[columns])
+        normalized = (values - self.mean_[columns]) / self.std_[columns]
+        if self.clip_ is not None:
+            np.clip(normalized, -self.clip_, self.clip_, out=normalized)
+        return normalized
+
+    def __call__(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim != 1:
+            if not self.frozen_:
+                self.update(values)
+            return self.transform(values)
+
+        # One state: log-scaled once, in the buffers
+        value = self.__log_scale_one(values)
+        if self.frozen_:
+            pass
+        elif self.count_ < self.update_every_:
+            self.__update_one(value)
+        else:
+            self.pending_[self.num_pending_] = value
+            self.num_pending_ += 1
+            if self.num_pending_ == self.update_every_:
+                self.flush()
+        normalized = value - self.mean_
+        normalized /= self.std_
+        if self.clip_ is not None:
+            np.clip(normalized, -self.clip_, self.clip_, out=normalized)
+        return normalized
+
+    def save(self, path):
+        '''
+        A method to save the statistics and the settings as an npz file
+        '''
+        np.savez(path, count=self.count_, mean=self.mean_, m2=self.m2_, is_log=self.is_log_, epsilon=self.epsilon_,
+                 clip=np.nan if self.clip_ is None else self.clip_, frozen=self.frozen_, pending=self.pending_[:self.num_pending_])
+
+    def load(self, path):
+        '''
+        A method to restore a normalizer saved with save in place. Returns it.
+        '''
+        with np.load(path) as values:
+            assert len(values["mean"]) == self.dimension_, "The saved normalizer has another dimension"
+            clip = float(values["clip"])
+            self.is_log_[:] = values["is_log"]
+            self.epsilon_ = float(values["epsilon"])
+            self.clip_ = None if np.isnan(clip) else clip
+            self.count_ = int(values["count"])
+            self.mean_[:] = values["mean"]
+            self.m2_[:] = values["m2"]
+            self.frozen_ = bool(values["frozen"])
+            self.num_pending_ = len(values["pending"])
+            assert self.num_pending_ < self.update_every_ or not self.num_pending_, "The saved normalizer has more pending states than update_every"
+            self.pending_[:self.num_pending_] = values["pending"]
+        self.log_columns_ = np.flatnonzero(self.is_log_)
+        self.__update_std()
+        return self
+
+    def __log_scale_one(self, values):
+        '''
+        A private method that log-scales one state into the value buffer
+        '''
+        value = self.value_
+        value[:] = values
+        if len(self.log_columns_):
+            value[self.log_columns_] = np.log1p(value[self.log_columns_])
+        return value
+
+    def __update_one(self, value):
+        '''
+        A private method to add one log-scaled state to the statistics with Welford's update
+        '''
+        self.count_ += 1
+        delta = np.subtract(value, self.mean_, out=self.delta_)
+        self.mean_ += delta / self.count_
+        delta *= value - self.mean_
+        self.m2_ += delta
+        self.__update_std()
+
+    def __update_std(self):
+        '''
+        A private method to recompute the standard deviations from the statistics
+        '''
+        np.divide(self.m2_, max(self.count_, 1), out=self.std_)
+        np.sqrt(self.std_, out=self.std_)
+        self.std_[self.std_ < self.epsilon_] = 1.
+
+    @staticmethod
+    def __log_scale(values, is_log):
+        '''
+        A private method that applies log1p to the log-scaled columns of a copy of values
+        '''
+        if is_log.any():
+            values = values.copy()
+            values[..., is_log] = np.log1p(values[..., is_log])
+        return values
@@ -187,6 +187,100 @@ class Portfolio:
         return f"{self.portfolio_coin_: .2f} coins, {self.portfolio_cash_: .2f} cash, {self.get_current_value(current_price): .2f} current value, {self.get_returns_percent(current_price): .2f}% returns"
 
 
+class PortfolioBatch:
+    '''
+    N independent portfolios stored as numpy arrays. Buy, sell and hold are applied with
+    masked vector operations following the exact arithmetic of Portfolio, so the states
+    are bit-identical to N scalar Portfolio objects fed the same prices and actions.
+    '''
+    def __init__(self, num_portfolios, spending_limit=20_000, num_coins_per_order=1., metrics=METRICS, final_price=0.0, spread=SPREAD):
+        self.num_portfolios_ = num_portfolios
+        self.final_price_ = final_price
+        self.spending_limit_ = spending_limit
+        self.num_coins_per_order_ = num_coins_per_order
+        self.metrics_ = metrics
+        self.spread_ = spread
+
+        self.portfolio_coin_ = np.zeros(num_portfolios)
+        self.portfolio_cash_ = np.zeros(num_portfolios)
+        self.bought_price_ = np.zeros(num_portfolios)
+        self.cash_used_ = np.zeros(num_portfolios)
+
+        # Creating the state dictionary, one array per metric
+        self.state_dict_ = {metric: np.zeros(num_portfolios) for metric in METRICS}
+
+    def get_current_value(self, current_price):
+        '''
+        Method to get the current total value of every portfolio
+        '''
+        sell_price = current_price * (1 - self.spread_)
+        return self.portfolio_coin_ * sell_price + self.portfolio_cash_
+
+    def get_returns_percent(self, current_price):
+        '''
+        A method that returns the returns of every portfolio since the experiment started
+        '''
+        has_spent = self.cash_used_ != 0.0
+        cash_used = np.where(has_spent, self.cash_used_, 1.0)
+        returns = 100 * (self.get_current_value(current_price) - self.cash_used_) / cash_used
+        return np.where(has_spent, returns, 0.0)
+
+    def apply_action(self, current_price, actions):
+        '''
+        A method to apply an array of actions (either buy, sell or hold) to the portfolios
+        and update the internal states after the actions. The current price is either a
+        scalar or one price per portfolio. Returns the actions actually taken.
+        '''
+        actions = np.asarray(actions)
+        assert np.all((0 <= actions) & (actions <= 2)), "Action should be one of: 0, 1 or 2"
+        current_price = np.broadcast_to(np.asarray(current_price, dtype=np.float64), (self.num_portfolios_,))
+        actions = actions.copy()
+        has_price = current_price != 0
+
+        # BUY, only within the spending limit
+        buy_price = current_price * (1 + self.spread_)
+        is_buying = (actions == 1) & has_price & ((self.cash_used_ + buy_price) <= self.spending_limit_)
+        coin_to_buy = self.num_coins_per_order_
+        self.portfolio_coin_ = np.where(is_buying, self.portfolio_coin_ + coin_to_buy, self.portfolio_coin_)
+        self.cash_used_ = np.where(is_buying, self.cash_used_ + coin_to_buy * buy_price, self.cash_used_)
+        if coin_to_buy <= 0:
+            actions[is_buying] = 0
+
+        # SELL, there's a min so that we don't sell more coins than available
+        sell_price = current_price * (1 - self.spread_)
+        is_selling = (actions == 2) & has_price
+        coin_to_sell = np.minimum(self.num_coins_per_order_, self.portfolio_coin_)
+        self.portfolio_coin_ = np.where(is_selling, self.portfolio_coin_ - coin_to_sell, self.portfolio_coin_)
+        self.portfolio_cash_ = np.where(is_selling, self.portfolio_cash_ + coin_to_sell * sell_price, self.portfolio_cash_)
+        actions[is_selling & (coin_to_sell <= 0)] = 0
+
+        # Update states
+        self.state_dict_["coin"] = self.portfolio_coin_
+        self.state_dict_["cash"] = self.portfolio_cash_
+        self.state_dict_["total_value"] = self.get_current_value(current_price)
+        self.state_dict_["is_holding_coin"] = (self.portfolio_coin_ > 0) * 1.
+        self.state_dict_["return_since_entry"] = self.get_returns_percent(current_price)
+
+        return actions
+
+    def reset(self, mask=None):
+        '''
+        A method to reset all the portfolios, or only the ones selected by a boolean mask
+        '''
+        if mask is None:
+            mask = np.ones(self.num_portfolios_, dtype=bool)
+        for values in [self.portfolio_coin_, self.portfolio_cash_, self.bought_price_, self.cash_used_, *self.state_dict_.values()]:
+            values[mask] = 0.
+
+    def get_states(self, metrics=None):
+        '''
+        A method to return the internal portfolio states as a (portfolios, metrics) array
+        '''
+        if not metrics:
+            metrics = self.metrics_
+        return np.stack([self.state_dict_[metric] for metric in metrics], axis=1)
+
+
 if __name__ == "__main__":
     from loader import TradingDataLoader
     from environments import TradingBotEnv
@@ -0,0 +1,98 @@
+'''
+The file that contains the training loop profiler. The runners take a 'profiler' and
+call lap(stage, t) after every stage of their loop, which adds the time since t to the
+stage and returns the current time. The default NullProfiler does not read the clock,
+so the instrumentation costs one no-op method call per stage when profiling is off.
+'''
+import json
+import time
+from collections import defaultdict
+
+
+class Profiler:
+    '''
+    A profiler recording the cumulative wall time and the number of calls of every stage
+    of a loop. report() summarizes them, e.g. at the end of every episode, keeps the
+    report in reports_, appends it to the 'path' JSONL file if any, then starts over.
+    '''
+    def __init__(self, path=None):
+        self.path_ = path
+        self.totals_ = defaultdict(float)
+        self.counts_ = defaultdict(int)
+        self.started_ = None
+        self.reports_ = []
+
+    def start(self):
+        '''
+        A method to start timing a loop. Returns the current time.
+        '''
+        self.started_ = time.perf_counter()
+        return self.started_
+
+    def lap(self, stage, started):
+        '''
+        A method to add the time since 'started' to a stage. Returns the current time.
+        '''
+        now = time.perf_counter()
+        self.totals_[stage] += now - started
+        self.counts_[stage] += 1
+        return now
+
+    def report(self, transitions=0, updates=0, **fields):
+        '''
+        A method that returns the stages of the loop since start, sorted by cumulative
+        time, and the transitions and updates per second. Extra fields, e.g. the episode,
+        are added to the report.
+        '''
+        wall = time.perf_counter() - self.started_
+        stages = {
+            stage: {
+                "total_s": total,
+                "calls": self.counts_[stage],
+                "mean_us": 1e6 * total / self.counts_[stage],
+                "share": total / wall if wall else 0.,
+            }
+            for stage, total in sorted(self.totals_.items(), key=lambda item: -item[1])
+        }
+        report = {
+            **fields,
+            "wall_s": wall,
+            "transitions": transitions,
+            "transitions_per_sec": transitions / wall if wall else 0.,
+            "updates": updates,
+            "updates_per_sec": updates / wall if wall else 0.,
+            "stages": stages,
+        }
+        self.reports_.append(report)
+        if self.path_:
+            with open(self.path_, "a") as f:
+                f.write(json.dumps(report) + "\n")
+        self.totals_.clear()
+        self.counts_.clear()
+        return report
+
+
+class NullProfiler(Profiler):
+    '''
+    A profiler that records nothing
+    '''
+    def start(self):
+        return None
+
+    def lap(self, stage, started):
+        return None
+
+    def report(self, transitions=0, updates=0, **fields):
+        return None
+
+NULL_PROFILER = NullProfiler()
+
+
+def format_report(report):
+    '''
+    A function that formats a report as a table of the stages
+    '''
+    lines = [f"{report['wall_s']: .2f} s - {report['transitions_per_sec']: .0f} transitions/sec - {report['updates_per_sec']: .1f} updates/sec"]
+    for stage, values in report["stages"].items():
+        lines.append(f"  {stage:<28}{values['total_s']: 9.3f} s{values['calls']: 10d} calls{values['mean_us']: 10.1f} us{100 * values['share']: 7.1f}%")
+    return "\n".join(lines)
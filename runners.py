@@ -1,143 +1,394 @@
 '''
 The file that contains the training utility functions
 '''
+import time
 import numpy as np
 import pickle as pk
 
-def run_agent(agent, environment, portfolio):
+from memory import ReplayBuffer, PrioritizedReplayBuffer, IndexedReplayBuffer, NStepTransitions
+from checkpoints import save_checkpoint, latest_checkpoint, load_checkpoint
+from profiler import NULL_PROFILER
+from history import empty_history, save_history
+from metrics import MetricsSink, NULL_METRICS, LOSS_BUCKETS, LATENCY_BUCKETS
+
+# The progress lines of the runners, for a metrics.MetricsSink console
+RUN_PROGRESS = "Iteration: {run_iterations_total:.0f} - Action: {run_action:.0f} - Reward: {run_reward: .4f} - Price: {run_price: .2f} - Cash: {run_cash: .2f} - Coins: {run_coins: .4f}"
+TRAIN_PROGRESS = "Episode: {train_episode:.0f}/{train_episodes:.0f} -  Avg. loss: {train_loss: .4f} - Transitions: {train_transitions_total:.0f} - Value: {train_portfolio_value: .2f}"
+
+def normalize_batch(normalizer, batch):
+    '''
+    A function that normalizes the states of a (states, actions, new_states, rewards, dones)
+    batch with the current statistics of a normalizer
+    '''
+    states, actions, new_states, rewards, dones = batch
+    return normalizer.transform(states), actions, normalizer.transform(new_states), rewards, dones
+
+def run_agent(agent, environment, portfolio, profiler=None, metrics=None):
     '''
-    A function that trains any agent in any environment with any portfolio
+    A function that trains any agent in any environment with any portfolio. With a
+    'profiler' (see profiler.Profiler), the time of every stage of the loop is recorded
+    and reported at the end of the episode. The progress goes to 'metrics' (see
+    metrics.MetricsSink), by default a sink printing RUN_PROGRESS every second.
     '''
-    history = {"cash": [], "coins": []}
+    profiler = profiler or NULL_PROFILER
+    own_metrics = metrics is None
+    metrics = MetricsSink(console=RUN_PROGRESS) if own_metrics else metrics
+    iterations, action_gauge, reward_gauge, price_gauge, cash_gauge, coins_gauge = (
+        metrics.counter("run_iterations_total"), metrics.gauge("run_action"), metrics.gauge("run_reward"),
+        metrics.gauge("run_price"), metrics.gauge("run_cash"), metrics.gauge("run_coins"))
+    history = {"cash": empty_history(environment.length_), "coins": empty_history(environment.length_)}
     is_done = False
     agent.agent_init()
     action = agent.agent_start(state=None)
     i = 0
+    t = profiler.start()
     while not is_done:
         i += 1
         portfolio.apply_action(environment.get_current_price(), action)
+        t = profiler.lap("portfolio.apply_action", t)
         is_done, state = environment.step()
         current_reward = environment.get_reward(action)
-
-        if i%1000 == 1:
-            print(f"Iteration: {i}\n")
-            print(f"Current holdings: {portfolio.get_current_holdings(environment.get_current_price())}\n")
-            print(f"Reward: {environment.get_reward(action)}\n")
-            print(f"Current Price: {environment.get_current_price()}\n")
+        t = profiler.lap("environment.step", t)
 
         current_price = environment.get_current_price()
         current_cash = portfolio.portfolio_cash_
         current_coins = portfolio.portfolio_coin_
         action = agent.agent_step(current_reward, state, current_cash, current_coins, current_price)
+        t = profiler.lap("agent.step", t)
 
         # Save in history to watch later
-        history["cash"].append(current_cash)
-        history["coins"].append(current_coins)
+        history["cash"][i - 1] = current_cash
+        history["coins"][i - 1] = current_coins
 
-        if i%1000 == 1:
-            print(f"Action: {action}\n")
+        metrics.inc(iterations)
+        metrics.set(action_gauge, action)
+        metrics.set(reward_gauge, current_reward)
+        metrics.set(price_gauge, current_price)
+        metrics.set(cash_gauge, current_cash)
+        metrics.set(coins_gauge, current_coins)
+        metrics.tick()
+        t = profiler.lap("bookkeeping", t)
+    metrics.end_progress()
+    if own_metrics:
+        metrics.close()
+    history = {column: values[:i] for column, values in history.items()}
     print(f"Final holdings: {portfolio.get_current_holdings(environment.get_current_price())}")
+    profiler.report(transitions=i)
     return history
 
-def train_dqn_agent(agent, environment, portfolio, episodes=10, batch_size=32, max_memory_size=4_000, seed=97428979, save=None):
+def train_dqn_agent(agent, environment, portfolio, episodes=10, batch_size=32, max_memory_size=4_000, seed=97428979, save=None, eviction="random",
+                    target_update=None, tau=None, double_dqn=None, prioritized=False, alpha=.6, beta=.4, beta_increment=1e-3,
+                    loss_history=None, checkpoint_dir=None, checkpoint_every=1, resume=False, profiler=None, normalizer=None,
+                    metrics=None, history_path=None):
     '''
-    A function to train a dqn agent over multiple episodess
+    A function to train a dqn agent over multiple episodess. If any of 'target_update',
+    'tau' or 'double_dqn' is given, it overrides the target network of the agent, the
+    ones left to None keeping their setting.
+    With 'prioritized', transitions are sampled proportionally to their TD errors
+    ** alpha and the loss is corrected with importance-sampling weights ** beta, beta
+    growing by 'beta_increment' after every batch until it reaches 1.
+    If a 'loss_history' list is given, the average loss of every episode is appended to it.
+    With a 'checkpoint_dir', a checkpoint is written every 'checkpoint_every' episodes and,
+    with 'resume', training restarts from the last one there, on the same trajectory as
+    an uninterrupted run. The memory, emptied every episode, is not saved, only the
+    state of its random generator. With a 'profiler', the time of every stage of the loop is
+    recorded and reported at the end of every episode.
+    If the environment has lookback windows (observation_window), the memory only stores
+    their indices, see IndexedReplayBuffer. If the agent has n_steps > 1, n-step
+    transitions are stored, see NStepTransitions.
+    With a 'normalizer' (see normalization.RunningNormalizer), the agent sees normalized
+    states: the memory keeps the raw ones and sampled batches are normalized with the
+    current statistics. The normalizer is saved in the checkpoints.
+    The progress goes to 'metrics' (see metrics.MetricsSink), by default a sink printing
+    TRAIN_PROGRESS every second. The portfolio values of every episode are returned as
+    float32 arrays and written to 'history_path' if given, see history.save_history.
     '''
+    profiler = profiler or NULL_PROFILER
+    if target_update is not None or tau is not None or double_dqn is not None:
+        # The settings left to None keep the ones of the agent
+        if target_update is None and tau is None:
+            target_update, tau = agent.target_update_, agent.tau_
+        double_dqn = agent.double_dqn_ if double_dqn is None else bool(double_dqn)
+        if (target_update, tau, double_dqn) != (agent.target_update_, agent.tau_, agent.double_dqn_):
+            agent.set_target_network(target_update=target_update, tau=tau, double_dqn=double_dqn)
     assert max_memory_size >= batch_size, "The maximum memory size must be superior to the batch size"
     random_gen = np.random.default_rng(seed=seed)
+    windows = getattr(environment, "windows_", None)
+    state_dimension = environment.get_metrics().size + len(portfolio.metrics_)
+    if windows is not None:
+        assert not prioritized, "Prioritized replay is not available with lookback windows"
+        memory = IndexedReplayBuffer(max_memory_size, windows, len(portfolio.metrics_), eviction=eviction, random_gen=random_gen)
+    elif prioritized:
+        memory = PrioritizedReplayBuffer(max_memory_size, state_dimension, alpha=alpha, beta=beta, beta_increment=beta_increment, eviction=eviction, random_gen=random_gen)
+    else:
+        memory = ReplayBuffer(max_memory_size, state_dimension, eviction=eviction, random_gen=random_gen)
+    writer = NStepTransitions(memory, agent.n_steps_, agent.discount_) if agent.n_steps_ > 1 else memory
+
+    own_metrics = metrics is None
+    metrics = MetricsSink(console=TRAIN_PROGRESS) if own_metrics else metrics
+    episode_gauge, episodes_gauge, loss_gauge, value_gauge, memory_gauge = (
+        metrics.gauge("train_episode"), metrics.gauge("train_episodes"), metrics.gauge("train_loss"),
+        metrics.gauge("train_portfolio_value"), metrics.gauge("train_memory_size"))
+    transitions, updates = metrics.counter("train_transitions_total"), metrics.counter("train_updates_total")
+    batch_losses = metrics.histogram("train_batch_loss", buckets=LOSS_BUCKETS)
+    metrics.set(episodes_gauge, episodes)
+
+    portfolio_history, episode_losses, start_episode = {}, [], 0
+    checkpoint = latest_checkpoint(checkpoint_dir) if checkpoint_dir and resume else None
+    if checkpoint is not None:
+        state, arrays = load_checkpoint(checkpoint, agent, normalizer=normalizer)
+        start_episode, episode_losses = state["episode"], state["loss_history"]
+        # The memory is cleared every episode, only its random generator (and beta) carry on
+        memory.load_config(state["memory"])
+        portfolio_history = {int(episode): np.array(values, dtype=np.float32) for episode, values in arrays.items()}
+        if loss_history is not None:
+            loss_history.extend(episode_losses)
+        print(f"Resuming from {checkpoint}")
 
-    portfolio_history = {}
-    for episode in range(episodes):
-        portfolio_history[episode] = []
+    for episode in range(start_episode, episodes):
+        episode_values = empty_history(environment.length_)
         _, _ = environment.reset(), portfolio.reset()
-        i, processed_samples, tot_loss, is_done, memory = 0, 0, 0., False, []
+        i, num_updates, processed_samples, tot_loss, is_done = 0, 0, 0, 0., False
+        memory.clear()
+        if writer is not memory:
+            writer.clear()
+        metrics.set(episode_gauge, episode + 1)
+        metrics.set(loss_gauge, 0.)
+        t = profiler.start()
 
-        # Get initial state
-        state = [environment.get_metrics(), portfolio.get_states()]
-        state = np.concatenate(state)
+        # Get initial state, and what the memory stores of it
+        market_index, portfolio_state = environment.current_index_, portfolio.get_states()
+        state = np.concatenate([environment.get_metrics().ravel(), portfolio_state])
+        entry = (market_index, portfolio_state) if windows is not None else state
 
         while not is_done:
             # Choose action
-            action = agent.step(state)
+            if normalizer is not None:
+                policy_state = normalizer(state)
+                t = profiler.lap("normalizer", t)
+            action = agent.step(policy_state if normalizer is not None else state)
+            t = profiler.lap("agent.step", t)
 
             # Update the portfolio and retrieve the new state
             current_price = environment.get_current_price()
             portfolio.apply_action(current_price, action)
             portfolio_state = portfolio.get_states()
+            t = profiler.lap("portfolio.apply_action", t)
 
             # Update the environment and retrieve the new state as well as the reward
+            market_index = environment.current_index_
             is_done, env_state = environment.step()
             reward = environment.get_reward(action)
+            t = profiler.lap("environment.step", t)
 
             # Build the full state
-            new_state = np.concatenate([env_state, portfolio_state])
+            new_state = np.concatenate([env_state.ravel(), portfolio_state])
+            new_entry = (market_index, portfolio_state) if windows is not None else new_state
+            t = profiler.lap("state", t)
 
             # Update the memory
-            memory.append([state, action, new_state, reward, is_done])
+            writer.add(entry, action, new_entry, reward, is_done)
+            t = profiler.lap("memory.add", t)
 
             # Update state and action
-            state = new_state
+            state, entry = new_state, new_entry
             
             # Save the current portfolio value in history
-            portfolio_history[episode].append(portfolio.get_current_value(current_price))
+            current_value = portfolio.get_current_value(current_price)
+            episode_values[i] = current_value
+            metrics.inc(transitions)
+            metrics.set(value_gauge, current_value)
 
-            if len(memory) > max_memory_size:
-                memory.pop(random_gen.integers(max_memory_size))
-
-            # We train every 100 steps
-            if i % 100 == 1:
-                if len(memory) < batch_size:
-                    batch = memory
+            # We train every 100 steps, once n-step transitions reached the memory
+            if i % 100 == 1 and len(memory):
+                t = profiler.lap("bookkeeping", t)
+                if prioritized:
+                    batch, indices, weights = memory.sample(batch_size)
+                    if normalizer is not None:
+                        batch = normalize_batch(normalizer, batch)
+                    t = profiler.lap("memory.sample", t)
+                    loss = agent.train(batch, weights=weights)
+                    t = profiler.lap("agent.train", t)
+                    memory.update_priorities(indices, agent.td_errors_)
+                    t = profiler.lap("memory.update_priorities", t)
                 else:
-                    batch = random_gen.choice(np.array(memory, dtype=object), size=batch_size)
-
-                tot_loss += agent.train(batch)
-                processed_samples += len(batch)
-
-                print(
-                    f"Episode: {episode + 1}/{episodes} -  Avg. loss: {tot_loss/processed_samples: .4f}",
-                    end='\r'
-                    )
+                    batch = memory.sample(batch_size)
+                    if normalizer is not None:
+                        batch = normalize_batch(normalizer, batch)
+                    t = profiler.lap("memory.sample", t)
+                    loss = agent.train(batch)
+                    t = profiler.lap("agent.train", t)
+                tot_loss += loss
+                processed_samples += len(batch[0])
+                num_updates += 1
+                metrics.inc(updates)
+                metrics.observe(batch_losses, loss)
+                metrics.set(loss_gauge, tot_loss / processed_samples)
+                metrics.set(memory_gauge, len(memory))
             i += 1
-        print(f"\nEPISODE OVER: {portfolio.get_current_holdings(current_price)}")
+            metrics.tick()
+            t = profiler.lap("bookkeeping", t)
+        portfolio_history[episode] = episode_values[:i]
+        metrics.end_progress()
+        metrics.flush()
+        print(f"EPISODE OVER: {portfolio.get_current_holdings(current_price)}")
+        profiler.report(transitions=i, updates=num_updates, episode=episode)
+        episode_losses.append(tot_loss / max(processed_samples, 1))
+        if loss_history is not None:
+            loss_history.append(episode_losses[-1])
+        if checkpoint_dir and ((episode + 1) % checkpoint_every == 0 or episode + 1 == episodes):
+            save_checkpoint(checkpoint_dir, episode + 1, agent, normalizer=normalizer,
+                            state={"episode": episode + 1, "loss_history": episode_losses, "memory": memory.get_config()},
+                            arrays={str(episode): values for episode, values in portfolio_history.items()})
 
     if save:
         with open(save, 'wb') as f:
             pickler = pk.Pickler(f)
             pickler.dump(agent.model)
-            
+    if history_path:
+        save_history(history_path, portfolio_history)
+
+    if own_metrics:
+        metrics.close()
     return portfolio_history
 
-def test_dqn_agent(agent, environment, portfolio):
+def test_dqn_agent(agent, environment, portfolio, batched=False, stats=None, profiler=None, action_history=None, normalizer=None):
     '''
-    A function to run a dqn agent through a whole episode
+    A function to run a dqn agent through a whole episode. With 'batched', the market part
+    of the states of the whole episode goes through the first layer of the model at once
+    and the rest of the policy runs in numpy, see SplitPolicy. If a 'stats' dictionary is
+    given, the inference throughput in steps per second is stored in it. With a 'profiler',
+    the time of every stage of the loop is recorded and reported at the end of the episode.
+    If an 'action_history' list is given, the actions taken are appended to it.
+    Returns the portfolio values as a float32 array.
+    With a 'normalizer', the agent sees normalized states. It should be frozen, and it
+    must be with 'batched'.
     '''
-    portfolio_history = []
+    profiler = profiler or NULL_PROFILER
+    portfolio_history = empty_history(environment.length_)
     _, _ = environment.reset(), portfolio.reset()
-    i, is_done = 0, False
+    i, is_done, inference_time = 0, False, 0.
+    t = profiler.start()
+
+    if batched:
+        # The market states are the first row, then every row until the end of the episode
+        start = environment.current_index_
+        end = start + int(np.argmax(environment.is_done_[start:]))
+        started = time.perf_counter()
+        market_dimension = environment.get_metrics().size
+        policy = agent.get_split_policy(market_dimension)
+        market_states = environment.get_observations(np.r_[start, start:end])
+        if normalizer is not None:
+            assert normalizer.frozen_, "Batched evaluation needs a frozen normalizer"
+            market_states = normalizer.transform(market_states, columns=slice(None, market_dimension))
+        projected = policy.project(market_states)
+        inference_time += time.perf_counter() - started
+        t = profiler.lap("policy.project", t)
 
     # Get initial state
-    state = [environment.get_metrics(), portfolio.get_states()]
-    state = np.concatenate(state)
+    portfolio_state = portfolio.get_states()
+    if not batched:
+        state = np.concatenate([environment.get_metrics().ravel(), portfolio_state])
 
     while not is_done:
         # Choose action
-        action = agent.step(state)
+        started = time.perf_counter()
+        if batched:
+            action = policy.step(projected[i], portfolio_state if normalizer is None else normalizer.transform(portfolio_state, columns=slice(market_dimension, None)))
+        else:
+            action = agent.step(state if normalizer is None else normalizer(state))
+        inference_time += time.perf_counter() - started
+        t = profiler.lap("agent.step", t)
 
         current_price = environment.get_current_price()
-        portfolio_history.append(portfolio.get_current_value(current_price))
+        portfolio_history[i] = portfolio.get_current_value(current_price)
+        if action_history is not None:
+            action_history.append(action)
+        t = profiler.lap("bookkeeping", t)
         
         # Update the portfolio and retrieve the new state
         portfolio.apply_action(current_price, action)
         portfolio_state = portfolio.get_states()
+        t = profiler.lap("portfolio.apply_action", t)
 
         # Update the environment and retrieve the new state
         is_done, env_state = environment.step()
+        t = profiler.lap("environment.step", t)
 
         # Build the full state
-        state = np.concatenate([env_state, portfolio_state])
+        if not batched:
+            state = np.concatenate([env_state.ravel(), portfolio_state])
+            t = profiler.lap("state", t)
 
         i += 1
 
     print(f"\nEPISODE OVER: {portfolio.get_current_holdings(current_price)}")
-    return portfolio_history
+    profiler.report(transitions=i)
+    if stats is not None:
+        stats["inference_steps_per_sec"] = i / inference_time
+    return portfolio_history[:i]
+
+def latency_report(latencies):
+    '''
+    A function that summarizes decision latencies in seconds as milliseconds percentiles
+    '''
+    latencies = 1e3 * np.asarray(latencies)
+    if not len(latencies):
+        return {"bars": 0}
+    return {
+        "bars": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": float(latencies.max()),
+        "mean_ms": float(latencies.mean()),
+    }
+
+def run_live(agent, environment, portfolio, feed, max_bars=None, report_every=1_000, normalizer=None, metrics=None):
+    '''
+    A function to let a trained agent trade every bar of a feed in a streaming environment.
+    The decision latency of a bar goes from its arrival to the chosen action: feature
+    update, state assembly and inference. Returns the portfolio history, the latency of
+    every bar in seconds and their summary. A 'normalizer', frozen after training,
+    normalizes the states the agent sees. With 'metrics' (see metrics.MetricsSink), the
+    bars, the decision latencies and the portfolio value are recorded there too, e.g. to
+    be served to Prometheus.
+    '''
+    metrics = metrics or NULL_METRICS
+    bars, latency_histogram, value_gauge = (metrics.counter("live_bars_total"), metrics.histogram("live_decision_latency_seconds", buckets=LATENCY_BUCKETS),
+                                            metrics.gauge("live_portfolio_value"))
+    portfolio_history, latencies = [], []
+    for i, bar in enumerate(feed):
+        if max_bars is not None and i >= max_bars:
+            break
+        received = time.perf_counter()
+
+        # Update the environment and build the full state
+        environment.push(bar)
+        _, env_state = environment.step()
+        state = np.concatenate([env_state, portfolio.get_states()])
+        if normalizer is not None:
+            state = normalizer(state)
+
+        # Choose action
+        action = agent.step(state)
+        latency = time.perf_counter() - received
+        latencies.append(latency)
+
+        # Update the portfolio
+        current_price = environment.get_current_price()
+        portfolio.apply_action(current_price, action)
+        current_value = portfolio.get_current_value(current_price)
+        portfolio_history.append(current_value)
+        metrics.inc(bars)
+        metrics.observe(latency_histogram, latency)
+        metrics.set(value_gauge, current_value)
+        metrics.tick()
+
+        if report_every and (i + 1) % report_every == 0:
+            report = latency_report(latencies[-report_every:])
+            print(f"Bar {i + 1} - p50: {report['p50_ms']: .3f} ms, p99: {report['p99_ms']: .3f} ms - {portfolio.get_current_holdings(current_price)}")
+
+    report = latency_report(latencies)
+    metrics.flush()
+    print(f"STREAM OVER: {report}")
+    return portfolio_history, latencies, report
@@ -0,0 +1,187 @@
+'''
+The file that contains the hyperparameter / seed sweep runner. Every run trains a fresh
+DQNAgent with train_dqn_agent and evaluates it with test_dqn_agent in a pool of worker
+processes that share the market data and the environment features through shared memory.
+Finished runs are appended to a JSONL file so an interrupted sweep resumes where it stopped.
+'''
+import os
+import json
+import time
+import hashlib
+import itertools
+import contextlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from workers import SharedArray, share_array
+
+# The configuration keys passed to DQNAgent, the others go to train_dqn_agent. Keep in
+# sync with the keyword arguments of DQNAgent.__init__ but 'seed'.
+AGENT_KEYS = ["epsilon", "discount", "target_update", "tau", "double_dqn", "n_steps"]
+
+# The state of every sweep worker process, set once by init_sweep_worker
+_worker = {}
+
+
+def make_grid(params):
+    '''
+    A function that returns every combination of the given {parameter: [values]}
+    '''
+    keys = sorted(params)
+    return [dict(zip(keys, values)) for values in itertools.product(*[params[key] for key in keys])]
+
+def make_random(params, num_samples, seed=0):
+    '''
+    A function that draws 'num_samples' configurations. A parameter is either a list of
+    values to choose from or a {"low", "high", "log"} range, integer if both bounds are
+    '''
+    random_gen = np.random.default_rng(seed=seed)
+    configs = []
+    for _ in range(num_samples):
+        config = {}
+        for key in sorted(params):
+            space = params[key]
+            if isinstance(space, dict):
+                low, high = space["low"], space["high"]
+                if space.get("log", False):
+                    value = float(np.exp(random_gen.uniform(np.log(low), np.log(high))))
+                else:
+                    value = float(random_gen.uniform(low, high))
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(round(value))
+            else:
+                value = space[random_gen.integers(len(space))]
+                value = value.item() if isinstance(value, np.generic) else value
+            config[key] = value
+        configs.append(config)
+    return configs
+
+def get_run_id(config, seed):
+    '''
+    A function that returns a stable identifier of a run, used to skip finished runs
+    '''
+    return hashlib.sha1(json.dumps({"config": config, "seed": seed}, sort_keys=True).encode()).hexdigest()[:12]
+
+def load_results(results_path):
+    '''
+    A function that loads the finished runs of a sweep as a data frame, one row per run
+    '''
+    if not os.path.exists(results_path):
+        return pd.DataFrame()
+    with open(results_path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame([{**row.pop("config"), **row} for row in rows])
+
+def init_sweep_worker(data_spec, features_spec, index, columns, lookback_window_size):
+    '''
+    The initializer of every worker process: attaches to the shared market data and
+    features and builds the environment once
+    '''
+    import torch
+    from environments import TradingBotEnv
+
+    torch.set_num_threads(1)
+    data = SharedArray(*data_spec)
+    features = SharedArray(*features_spec)
+    frame = pd.DataFrame(data.values_, index=index, columns=columns, copy=False)
+    _worker["shared"] = [data, features]
+    _worker["environment"] = TradingBotEnv(frame, lookback_window_size=lookback_window_size, features=features.values_)
+
+def run_sweep_config(run_id, config, seed):
+    '''
+    The function run by the workers: trains and tests an agent with the given configuration
+    '''
+    import torch
+    from portfolio import Portfolio
+    from models import DenseModel
+    from agents import DQNAgent
+    from runners import train_dqn_agent, test_dqn_agent
+
+    start = time.perf_counter()
+    environment = _worker["environment"]
+    portfolio = Portfolio()
+
+    torch.manual_seed(seed)
+    model = DenseModel(input_dimension=len(environment.metrics_) + len(portfolio.metrics_), output_dimension=3)
+    agent_kwargs = {key: value for key, value in config.items() if key in AGENT_KEYS}
+    train_kwargs = {key: value for key, value in config.items() if key not in AGENT_KEYS}
+    agent = DQNAgent(model, seed=seed, **agent_kwargs)
+
+    loss_history = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        train_dqn_agent(agent, environment, portfolio, seed=seed, loss_history=loss_history, **train_kwargs)
+        portfolio_history = test_dqn_agent(agent, environment, portfolio)
+
+    current_price = environment.get_current_price()
+    return {
+        "run_id": run_id,
+        "config": config,
+        "seed": seed,
+        "roi": float(portfolio.get_returns_percent(current_price)),
+        "final_value": float(portfolio_history[-1]),
+        "loss_curve": [float(loss) for loss in loss_history],
+        "wall_time": time.perf_counter() - start,
+    }
+
+def run_sweep(configs, results_path, data=None, seeds=(0,), num_workers=None, lookback_window_size=20):
+    '''
+    A function that runs every configuration with every seed across a process pool and
+    appends the results to 'results_path'. Runs already in the file are skipped.
+    Returns the results of all the runs of the file as a data frame.
+    '''
+    from loader import TradingDataLoader
+    from environments import TradingBotEnv
+
+    done = set(load_results(results_path).get("run_id", []))
+    runs = [(get_run_id(config, seed), config, seed) for config in configs for seed in seeds]
+    runs = [run for run in runs if run[0] not in done]
+    print(f"{len(done)} finished runs, {len(runs)} runs to go")
+    if not runs:
+        return load_results(results_path)
+
+    if data is None:
+        data = TradingDataLoader().data()
+    environment = TradingBotEnv(data, lookback_window_size=lookback_window_size)
+    shared_data = share_array(data.to_numpy(dtype=np.float64))
+    shared_features = share_array(environment.features_)
+
+    context = mp.get_context("spawn")
+    initargs = (shared_data.spec(), shared_features.spec(), data.index, list(data.columns), lookback_window_size)
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers or os.cpu_count(), mp_context=context,
+                                 initializer=init_sweep_worker, initargs=initargs) as pool:
+            futures = [pool.submit(run_sweep_config, *run) for run in runs]
+            for i, future in enumerate(as_completed(futures)):
+                result = future.result()
+                with open(results_path, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+                print(f"Run {i + 1}/{len(runs)} - {result['config']} seed {result['seed']}: ROI {result['roi']: .2f}%")
+    finally:
+        shared_data.close(unlink=True)
+        shared_features.close(unlink=True)
+
+    return load_results(results_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a grid or random search of train_dqn_agent + test_dqn_agent")
+    parser.add_argument("spec", help='A JSON file like {"search": "grid", "params": {"batch_size": [32, 256]}, "seeds": [0, 1]}')
+    parser.add_argument("--results", default="./sweep_results.jsonl", help="The JSONL file the runs are appended to")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes")
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    if spec.get("search", "grid") == "grid":
+        configs = make_grid(spec["params"])
+    else:
+        configs = make_random(spec["params"], spec["num_samples"], seed=spec.get("seed", 0))
+
+    results = run_sweep(configs, args.results, seeds=spec.get("seeds", [0]), num_workers=args.workers)
+    results.drop(columns=["loss_curve"]).to_csv(os.path.splitext(args.results)[0] + ".csv", index=False)
+    print(results.drop(columns=["loss_curve"]).sort_values("roi", ascending=False).to_string(index=False))
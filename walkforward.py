@@ -0,0 +1,199 @@
+'''
+The file that contains the walk-forward cross-validation engine. The history is split in
+rolling (or expanding) train windows, each followed by a test window, and every fold trains
+a fresh DQNAgent on its train window then evaluates it out of sample on its test window, in a
+pool of worker processes. The features are computed once over the whole history and shared:
+the environments of a fold are built on slices of that one array. Features only look back,
+so the first bars of a window use the bars before it, as they would have live.
+'''
+import os
+import time
+import contextlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from workers import SharedArray, share_array
+from sweeps import AGENT_KEYS
+
+# The state of every walk-forward worker process, set once by init_walk_forward_worker
+_worker = {}
+
+
+def make_folds(index, train_period, test_period, step=None, expanding=False):
+    '''
+    A function that splits a DatetimeIndex in walk-forward folds: 'train_period' of bars
+    followed by 'test_period' of bars, moved forward by 'step' (the test period by
+    default) until the test window would go past the last bar. Periods are anything
+    pd.Timedelta accepts, e.g. "180D". With 'expanding', every train window starts at the
+    first bar. Returns one dictionary per fold with the dates of its windows and their
+    rows as 'train' and 'test' slices, none if there are less than two bars.
+    '''
+    if len(index) < 2:
+        return []
+    train_period, test_period = pd.Timedelta(train_period), pd.Timedelta(test_period)
+    step = pd.Timedelta(step) if step is not None else test_period
+    folds = []
+    start = index[0]
+    while start + train_period + test_period <= index[-1] + (index[-1] - index[-2]):
+        train_start = index[0] if expanding else start
+        train_end = start + train_period
+        test_end = train_end + test_period
+        positions = index.searchsorted([train_start, train_end, test_end])
+        folds.append({
+            "fold": len(folds),
+            "train_start": str(train_start), "test_start": str(train_end), "test_end": str(test_end),
+            "train": slice(int(positions[0]), int(positions[1])),
+            "test": slice(int(positions[1]), int(positions[2])),
+        })
+        start += step
+    return folds
+
+def max_drawdown(equity):
+    '''
+    A function that returns the largest drop from a running peak of an equity curve, in
+    percent of that peak
+    '''
+    equity = np.asarray(equity, dtype=np.float64)
+    peaks = np.maximum.accumulate(equity)
+    return float(100 * np.max((peaks - equity) / peaks)) if len(equity) else 0.
+
+def init_walk_forward_worker(data_spec, features_spec, index, columns, lookback_window_size):
+    '''
+    The initializer of every worker process: attaches to the shared market data and
+    features of the whole history
+    '''
+    import torch
+
+    torch.set_num_threads(1)
+    data = SharedArray(*data_spec)
+    features = SharedArray(*features_spec)
+    _worker["shared"] = [data, features]
+    _worker["frame"] = pd.DataFrame(data.values_, index=index, columns=columns, copy=False)
+    _worker["features"] = features.values_
+    _worker["lookback_window_size"] = lookback_window_size
+
+def get_environment(start, end):
+    '''
+    A function that returns an environment over the rows [start, end) of the history,
+    on a slice of the shared features
+    '''
+    from environments import TradingBotEnv
+
+    return TradingBotEnv(_worker["frame"].iloc[start:end], lookback_window_size=_worker["lookback_window_size"],
+                         features=_worker["features"][start:end])
+
+def run_fold(fold, config, seed):
+    '''
+    The function run by the workers: trains a fresh agent on the train window of a fold
+    and evaluates it on its test window
+    '''
+    import torch
+    from portfolio import Portfolio
+    from models import DenseModel
+    from agents import DQNAgent
+    from runners import train_dqn_agent, test_dqn_agent
+    from backtest import backtest
+
+    start = time.perf_counter()
+    train, test = fold["train"], fold["test"]
+    train_environment = get_environment(train.start, train.stop)
+    test_environment = get_environment(test.start, test.stop)
+    portfolio = Portfolio()
+
+    torch.manual_seed(seed)
+    model = DenseModel(input_dimension=len(train_environment.metrics_) + len(portfolio.metrics_), output_dimension=3)
+    agent_kwargs = {key: value for key, value in config.items() if key in AGENT_KEYS}
+    train_kwargs = {key: value for key, value in config.items() if key not in AGENT_KEYS}
+    agent = DQNAgent(model, seed=seed, **agent_kwargs)
+
+    loss_history, actions = [], []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        train_dqn_agent(agent, train_environment, portfolio, seed=seed, loss_history=loss_history, **train_kwargs)
+        test_dqn_agent(agent, test_environment, portfolio, action_history=actions)
+
+    # The test path, to measure the drawdown of the profit and loss on top of the
+    # spending limit
+    prices = test_environment.prices_[:len(actions)]
+    path = backtest(prices, np.array(actions), spending_limit=portfolio.spending_limit_,
+                    num_coins_per_order=portfolio.num_coins_per_order_, spread=portfolio.spread_)
+    equity = portfolio.spending_limit_ + path["total_value"][0] - path["cash_used"][0]
+    first_price, last_price = prices[0] * (1 + portfolio.spread_), prices[-1] * (1 - portfolio.spread_)
+
+    return {
+        **{key: value for key, value in fold.items() if key not in ("train", "test")},
+        "seed": seed,
+        "train_bars": train.stop - train.start,
+        "test_bars": test.stop - test.start,
+        "roi": float(path["roi"][0]),
+        "max_drawdown": max_drawdown(equity),
+        "buy_and_hold_roi": float(100 * (last_price - first_price) / first_price),
+        "num_trades": int(np.count_nonzero(np.diff(path["coin"][0], prepend=0.))),
+        "final_loss": float(loss_history[-1]) if loss_history else None,
+        "wall_time": time.perf_counter() - start,
+    }
+
+def walk_forward(data, folds, config=None, seeds=(0,), num_workers=None, lookback_window_size=20):
+    '''
+    A function that runs every fold with every seed across a process pool. 'config' holds
+    the DQNAgent (see sweeps.AGENT_KEYS) and train_dqn_agent parameters. Returns one row
+    per fold and seed, sorted by fold.
+    '''
+    from environments import TradingBotEnv
+
+    config = config or {}
+    environment = TradingBotEnv(data, lookback_window_size=lookback_window_size)
+    shared_data = share_array(data.to_numpy(dtype=np.float64))
+    shared_features = share_array(environment.features_)
+
+    rows = []
+    context = mp.get_context("spawn")
+    initargs = (shared_data.spec(), shared_features.spec(), data.index, list(data.columns), lookback_window_size)
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers or os.cpu_count(), mp_context=context,
+                                 initializer=init_walk_forward_worker, initargs=initargs) as pool:
+            futures = [pool.submit(run_fold, fold, config, seed) for fold in folds for seed in seeds]
+            for future in as_completed(futures):
+                row = future.result()
+                rows.append(row)
+                print(f"Fold {row['fold']} ({row['test_start']} - {row['test_end']}) seed {row['seed']}: ROI {row['roi']: .2f}%, max drawdown {row['max_drawdown']: .2f}%")
+    finally:
+        shared_data.close(unlink=True)
+        shared_features.close(unlink=True)
+    return pd.DataFrame(rows).sort_values(["fold", "seed"], ignore_index=True)
+
+def summarize(results):
+    '''
+    A function that aggregates the out-of-sample ROI and drawdown of the folds
+    '''
+    columns = ["roi", "max_drawdown", "buy_and_hold_roi"]
+    summary = results[columns].agg(["mean", "std", "min", "median", "max"])
+    summary.loc["positive_folds"] = (results[["roi", "buy_and_hold_roi"]] > 0).mean()
+    return summary
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    from loader import TradingDataLoader
+
+    parser = argparse.ArgumentParser(description="Walk-forward cross-validation of a DQNAgent")
+    parser.add_argument("--train-period", default="180D", help="The length of the train windows")
+    parser.add_argument("--test-period", default="30D", help="The length of the test windows")
+    parser.add_argument("--step", default=None, help="How far the windows move between folds, the test period by default")
+    parser.add_argument("--expanding", action="store_true", help="Start every train window at the first bar")
+    parser.add_argument("--config", default="{}", help='The agent and training parameters as JSON, e.g. {"episodes": 2}')
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0], help="The seeds of every fold")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes")
+    parser.add_argument("--results", default="./walk_forward.csv", help="The csv file the fold results are written to")
+    args = parser.parse_args()
+
+    data = TradingDataLoader(start_date=None, end_date=None).data()
+    folds = make_folds(data.index, args.train_period, args.test_period, step=args.step, expanding=args.expanding)
+    print(f"{len(folds)} folds over {data.index[0]} - {data.index[-1]}")
+    results = walk_forward(data, folds, config=json.loads(args.config), seeds=args.seeds, num_workers=args.workers)
+    results.to_csv(args.results, index=False)
+    print(results.drop(columns=["wall_time"]).to_string(index=False))
+    print(summarize(results).to_string())
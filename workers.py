@@ -0,0 +1,392 @@
+'''
+The file that contains the actor/learner training mode: worker processes play episodes
+and stream their transitions through shared memory to a central learner that trains the
+agent and periodically sends the fresh weights back
+'''
+import time
+import queue
+import pickle as pk
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from memory import ReplayBuffer, PrioritizedReplayBuffer
+from metrics import MetricsSink
+
+# The progress line of the learner, for a metrics.MetricsSink console
+LEARNER_PROGRESS = "Episodes: {learner_episodes:.0f}/{learner_episodes_total:.0f} - Transitions/sec: {learner_transitions_per_sec: .0f} - Avg. loss: {learner_loss: .4f} - Lost: {learner_lost_transitions:.0f}"
+
+
+class SharedArray:
+    '''
+    A numpy array in a shared memory block. Create it from an array in the parent process
+    and attach to it from the workers with the spec() tuple, nothing is copied.
+    '''
+    def __init__(self, shape, dtype, name=None):
+        self.shape_ = tuple(shape)
+        self.dtype_ = np.dtype(dtype)
+        size = max(int(np.prod(self.shape_)) * self.dtype_.itemsize, 1)
+        self.shm_ = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name_ = self.shm_.name
+        self.values_ = np.ndarray(self.shape_, dtype=self.dtype_, buffer=self.shm_.buf)
+
+    def spec(self):
+        '''
+        A method that returns the arguments to attach to this array from another process
+        '''
+        return self.shape_, self.dtype_.str, self.name_
+
+    def close(self, unlink=False):
+        '''
+        A method to release the shared memory block
+        '''
+        self.values_ = None
+        self.shm_.close()
+        if unlink:
+            self.shm_.unlink()
+
+def share_array(values):
+    '''
+    A function that copies an array into a new SharedArray
+    '''
+    shared = SharedArray(values.shape, values.dtype)
+    shared.values_[...] = values
+    return shared
+
+
+class SharedTransitionRing:
+    '''
+    A single-writer single-reader ring of transitions in a shared memory block. The writer
+    (a worker) bumps a counter after every transition, the reader (the learner) copies
+    everything written since its last read. Transitions older than a full ring are lost,
+    as are the ones the writer overwrote while they were being copied: they are dropped
+    rather than read torn, and counted in lost_.
+    '''
+    def __init__(self, capacity, state_dimension, name=None):
+        self.capacity_ = capacity
+        self.state_dimension_ = state_dimension
+
+        layout = [
+            ("counter", np.int64, (1,)),
+            ("states", np.float32, (capacity, state_dimension)),
+            ("new_states", np.float32, (capacity, state_dimension)),
+            ("actions", np.int64, (capacity,)),
+            ("rewards", np.float32, (capacity,)),
+            ("dones", np.bool_, (capacity,)),
+        ]
+        size = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for _, dtype, shape in layout)
+        self.shm_ = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name_ = self.shm_.name
+
+        arrays, offset = {}, 0
+        for key, dtype, shape in layout:
+            arrays[key] = np.ndarray(shape, dtype=dtype, buffer=self.shm_.buf, offset=offset)
+            offset += arrays[key].nbytes
+        self.counter_ = arrays["counter"]
+        self.states_ = arrays["states"]
+        self.new_states_ = arrays["new_states"]
+        self.actions_ = arrays["actions"]
+        self.rewards_ = arrays["rewards"]
+        self.dones_ = arrays["dones"]
+        if name is None:
+            self.counter_[0] = 0
+        self.read_ = 0
+        self.lost_ = 0
+
+    def put(self, state, action, new_state, reward, is_done):
+        '''
+        A method to write a transition, only called by the worker owning the ring
+        '''
+        index = self.counter_[0] % self.capacity_
+        self.states_[index] = state
+        self.actions_[index] = action
+        self.new_states_[index] = new_state
+        self.rewards_[index] = reward
+        self.dones_[index] = is_done
+        self.counter_[0] += 1
+
+    def drain(self, memory):
+        '''
+        A method to move every transition written since the last drain into a replay
+        memory. Returns the number of transitions moved.
+        '''
+        written = int(self.counter_[0])
+        start = max(self.read_, written - self.capacity_)
+        if written == start:
+            self.lost_ += start - self.read_
+            self.read_ = written
+            return 0
+        indices = np.arange(start, written) % self.capacity_
+        states, actions, new_states = self.states_[indices], self.actions_[indices], self.new_states_[indices]
+        rewards, dones = self.rewards_[indices], self.dones_[indices]
+
+        # The writer may have gone on meanwhile: the transition it is writing at 'after'
+        # takes the slot of the one at after - capacity, so only the later ones are whole
+        after = int(self.counter_[0])
+        first = max(start, after - self.capacity_ + 1)
+        self.lost_ += first - self.read_
+        self.read_ = written
+        if first >= written:
+            return 0
+        kept = slice(first - start, None)
+        memory.add_batch(states[kept], actions[kept], new_states[kept], rewards[kept], dones[kept])
+        return written - first
+
+    def close(self, unlink=False):
+        '''
+        A method to release the shared memory block
+        '''
+        for key in ["counter_", "states_", "new_states_", "actions_", "rewards_", "dones_"]:
+            setattr(self, key, None)
+        self.shm_.close()
+        if unlink:
+            self.shm_.unlink()
+
+
+class SharedWeights:
+    '''
+    The parameters of a model flattened in a shared memory block along with a version
+    counter, so that workers only reload them when the learner published new ones
+    '''
+    def __init__(self, num_parameters, lock, name=None):
+        self.lock_ = lock
+        self.shm_ = shared_memory.SharedMemory(name=name, create=name is None, size=8 + 4 * num_parameters)
+        self.name_ = self.shm_.name
+        self.version_ = np.ndarray((1,), dtype=np.int64, buffer=self.shm_.buf)
+        self.values_ = np.ndarray((num_parameters,), dtype=np.float32, buffer=self.shm_.buf, offset=8)
+        if name is None:
+            self.version_[0] = 0
+
+    def publish(self, model):
+        '''
+        A method to write the parameters of the model, called by the learner
+        '''
+        import torch
+
+        with torch.no_grad(), self.lock_:
+            self.values_[:] = torch.nn.utils.parameters_to_vector(model.parameters()).numpy()
+            self.version_[0] += 1
+
+    def load(self, model, version):
+        '''
+        A method to load the parameters into the model if they are newer than 'version'.
+        Returns the version of the loaded parameters.
+        '''
+        import torch
+
+        if self.version_[0] == version:
+            return version
+        with self.lock_:
+            values = torch.from_numpy(self.values_.copy())
+            version = int(self.version_[0])
+        with torch.no_grad():
+            torch.nn.utils.vector_to_parameters(values, model.parameters())
+        return version
+
+    def close(self, unlink=False):
+        '''
+        A method to release the shared memory block
+        '''
+        self.version_, self.values_ = None, None
+        self.shm_.close()
+        if unlink:
+            self.shm_.unlink()
+
+
+def rollout_worker(worker_id, data, model, agent_kwargs, ring_spec, weights_spec, lock, results, episodes, sync_every, seed):
+    '''
+    The function run by every worker process: it plays 'episodes' episodes with its own
+    environment, portfolio and copy of the model, streams the transitions to its ring and
+    reloads the learner's weights every 'sync_every' steps
+    '''
+    import torch
+    from environments import TradingBotEnv
+    from portfolio import Portfolio
+    from agents import DQNAgent
+
+    torch.set_num_threads(1)
+    environment = TradingBotEnv(data)
+    portfolio = Portfolio()
+    agent = DQNAgent(model, seed=seed, **agent_kwargs)
+    ring = SharedTransitionRing(*ring_spec)
+    num_parameters, weights_name = weights_spec
+    weights = SharedWeights(num_parameters, lock, name=weights_name)
+    version = weights.load(agent.model, -1)
+
+    for episode in range(episodes):
+        portfolio_history = np.empty(environment.length_, dtype=np.float32)
+        _, _ = environment.reset(), portfolio.reset()
+        i, is_done = 0, False
+        state = np.concatenate([environment.get_metrics(), portfolio.get_states()])
+
+        while not is_done:
+            if i % sync_every == 0:
+                version = weights.load(agent.model, version)
+            action = agent.step(state)
+
+            current_price = environment.get_current_price()
+            portfolio.apply_action(current_price, action)
+            portfolio_state = portfolio.get_states()
+
+            is_done, env_state = environment.step()
+            reward = environment.get_reward(action)
+            new_state = np.concatenate([env_state, portfolio_state])
+
+            ring.put(state, action, new_state, reward, is_done)
+            state = new_state
+            portfolio_history[i] = portfolio.get_current_value(current_price)
+            i += 1
+
+        results.put((worker_id, episode, portfolio_history[:i]))
+
+    results.put((worker_id, None, None))
+    ring.close()
+    weights.close()
+
+def train_dqn_agent_parallel(agent, data, num_workers=4, episodes=10, batch_size=32, max_memory_size=4_000, seed=97428979, save=None,
+                             train_every=100, sync_every=1_000, ring_size=20_000, memory=None, metrics=None):
+    '''
+    A function to train a dqn agent with 'num_workers' rollout processes feeding a central
+    learner. The 'episodes' are spread over the workers and the learner makes one update
+    per 'train_every' collected transitions, as train_dqn_agent does, prioritized if
+    'memory' is a PrioritizedReplayBuffer. The progress goes
+    to 'metrics' (see metrics.MetricsSink), by default a sink printing LEARNER_PROGRESS
+    every second. Returns the portfolio history of every episode.
+    '''
+    assert max_memory_size >= batch_size, "The maximum memory size must be superior to the batch size"
+    import torch
+
+    context = mp.get_context("spawn")
+    random_gen = np.random.default_rng(seed=seed)
+    state_dimension = agent.model.l1_.in_features
+    if memory is None:
+        memory = ReplayBuffer(max_memory_size, state_dimension, random_gen=random_gen)
+
+    lock = context.Lock()
+    num_parameters = sum(parameter.numel() for parameter in agent.model.parameters())
+    weights = SharedWeights(num_parameters, lock)
+    weights.publish(agent.model)
+    rings = [SharedTransitionRing(ring_size, state_dimension) for _ in range(num_workers)]
+    results = context.Queue()
+
+    agent_kwargs = {"epsilon": agent.epsilon_, "discount": agent.discount_}
+    episodes_per_worker = [episodes // num_workers + (worker_id < episodes % num_workers) for worker_id in range(num_workers)]
+    processes = [
+        context.Process(
+            target=rollout_worker,
+            args=(worker_id, data, agent.model, agent_kwargs, (ring_size, state_dimension, ring.name_), (num_parameters, weights.name_),
+                  lock, results, episodes_per_worker[worker_id], sync_every, seed + 1 + worker_id),
+            daemon=True,
+        )
+        for worker_id, ring in enumerate(rings)
+    ]
+
+    own_metrics = metrics is None
+    metrics = MetricsSink(console=LEARNER_PROGRESS) if own_metrics else metrics
+    episodes_gauge, total_gauge, rate_gauge, loss_gauge = (metrics.gauge("learner_episodes"), metrics.gauge("learner_episodes_total"),
+                                                          metrics.gauge("learner_transitions_per_sec"), metrics.gauge("learner_loss"))
+    transitions, updates = metrics.counter("learner_transitions_total"), metrics.counter("learner_updates_total")
+    lost_gauge = metrics.gauge("learner_lost_transitions")
+    metrics.set(total_gauge, episodes)
+    prioritized = isinstance(memory, PrioritizedReplayBuffer)
+
+    def learn():
+        '''
+        The updates due for the transitions collected so far. Returns the summed loss and
+        the number of samples.
+        '''
+        nonlocal num_updates
+        loss, num_samples = 0., 0
+        while num_updates < num_collected // train_every and len(memory) > 0:
+            if prioritized:
+                batch, indices, sample_weights = memory.sample(batch_size)
+                loss += agent.train(batch, weights=sample_weights)
+                memory.update_priorities(indices, agent.td_errors_)
+            else:
+                batch = memory.sample(batch_size)
+                loss += agent.train(batch)
+            num_samples += len(batch[0])
+            num_updates += 1
+            metrics.inc(updates)
+            if num_updates % max(sync_every // train_every, 1) == 0:
+                weights.publish(agent.model)
+        return loss, num_samples
+
+    portfolio_history = {}
+    num_collected, num_updates, tot_loss, processed_samples, num_finished = 0, 0, 0., 0, 0
+    start = time.perf_counter()
+    try:
+        for process in processes:
+            process.start()
+
+        while num_finished < num_workers:
+            new_transitions = sum(ring.drain(memory) for ring in rings)
+            num_collected += new_transitions
+            loss, num_samples = learn()
+            tot_loss, processed_samples = tot_loss + loss, processed_samples + num_samples
+
+            # Once every worker exited, their last messages may still be in the pipe
+            all_exited = not any(process.is_alive() for process in processes)
+            try:
+                while num_finished < num_workers:
+                    worker_id, episode, values = results.get(timeout=5.) if all_exited else results.get_nowait()
+                    if episode is None:
+                        num_finished += 1
+                    else:
+                        portfolio_history[episode * num_workers + worker_id] = values
+            except queue.Empty:
+                if all_exited:
+                    raise RuntimeError("A rollout worker died before the end of its episodes")
+
+            if not new_transitions:
+                time.sleep(.001)
+
+            metrics.inc(transitions, new_transitions)
+            metrics.set(lost_gauge, sum(ring.lost_ for ring in rings))
+            metrics.set(episodes_gauge, len(portfolio_history))
+            metrics.set(rate_gauge, num_collected / (time.perf_counter() - start))
+            metrics.set(loss_gauge, tot_loss / max(processed_samples, 1))
+            metrics.tick()
+
+        # The transitions written after the last drain, before the finish messages
+        new_transitions = sum(ring.drain(memory) for ring in rings)
+        num_collected += new_transitions
+        loss, num_samples = learn()
+        tot_loss, processed_samples = tot_loss + loss, processed_samples + num_samples
+        metrics.inc(transitions, new_transitions)
+        metrics.set(lost_gauge, sum(ring.lost_ for ring in rings))
+        metrics.set(loss_gauge, tot_loss / max(processed_samples, 1))
+        metrics.end_progress()
+
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for ring in rings:
+            ring.close(unlink=True)
+        weights.close(unlink=True)
+        if own_metrics:
+            metrics.close()
+
+    if save:
+        with open(save, 'wb') as f:
+            pickler = pk.Pickler(f)
+            pickler.dump(agent.model)
+
+    return dict(sorted(portfolio_history.items()))
+
+
+if __name__ == "__main__":
+    import torch
+    from loader import TradingDataLoader
+    from models import DenseModel
+    from agents import DQNAgent
+
+    torch.manual_seed(seed=876438985230)
+    data = TradingDataLoader().data()
+    agent = DQNAgent(DenseModel(input_dimension=17, output_dimension=3))
+    portfolio_history = train_dqn_agent_parallel(agent, data, num_workers=4, episodes=4)
+    print({episode: values[-1] for episode, values in portfolio_history.items()})